@@ -1,4 +1,5 @@
 import sys
 
-if "pytest" not in sys.modules:
+# Only set up the GUI when loaded by Anki, so the exporter can be used headlessly (see cli.py)
+if "pytest" not in sys.modules and "aqt" in sys.modules:
     from . import main
@@ -0,0 +1,324 @@
+"""
+Export media from an Anki collection without the GUI.
+
+Example:
+    python -m media_exporter.cli collection.anki2 out/ --deck "Japanese::Vocab" --exts mp3 ogg
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any
+
+from anki.collection import Collection
+from anki.decks import DeckId
+from anki.errors import DBError, SearchError
+
+from .exporter import (
+    DEFAULT_COPY_WORKERS,
+    DeckMediaExporter,
+    MediaExporter,
+    MultiDeckMediaExporter,
+    SearchMediaExporter,
+)
+from .fileops import LINK_MODE_COPY, LINK_MODES
+from .media_index import MediaReferenceIndex
+from .pipeline import DEFAULT_QUEUE_SIZE, export_async
+from .sinks import ARCHIVE_FORMATS, ExportSink, FolderSink, make_archive_sink
+from .stats import ExportProgress
+from .transcode import TranscodeOptions, Transcoder
+
+
+def print_event(event: str, **data: Any) -> None:
+    print(json.dumps({"event": event, **data}), flush=True)
+
+
+def parse_args(argv: list[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="media_exporter",
+        description="Export media files referenced by notes of an Anki collection.",
+    )
+    parser.add_argument("collection", help="path to the .anki2 collection file")
+    parser.add_argument(
+        "dest", help="folder to export media files to, or archive path with --format"
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--deck",
+        nargs="+",
+        help="name of the deck to export media from; "
+        "if several decks are given, the media of each is exported to its own subfolder",
+    )
+    source.add_argument(
+        "--deck-tree",
+        help="name of a deck to export media from, with each subdeck in its own subfolder",
+    )
+    source.add_argument(
+        "--search", help="Anki search string of notes to export media from"
+    )
+    parser.add_argument(
+        "--fields", nargs="*", help="only include media in these fields (default: all)"
+    )
+    parser.add_argument(
+        "--exts",
+        nargs="*",
+        help="only include files with these extensions, without dots (default: all)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["folder", *ARCHIVE_FORMATS],
+        default="folder",
+        help="write files to a folder (default) or stream them into an archive",
+    )
+    parser.add_argument(
+        "--subfolders",
+        action="store_true",
+        help="organize media into subfolders corresponding to each subdeck",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_COPY_WORKERS,
+        help="number of files copied in parallel",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="scan notes and write files at the same time instead of scanning all notes first",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help="maximum number of note batches and files waiting between pipeline stages",
+    )
+    parser.add_argument(
+        "--no-incremental",
+        dest="incremental",
+        action="store_false",
+        help="copy all files even if they didn't change since the last export",
+    )
+    parser.add_argument(
+        "--hashes",
+        action="store_true",
+        help="record content hashes in the export manifest",
+    )
+    parser.add_argument(
+        "--link-mode",
+        choices=LINK_MODES,
+        default=LINK_MODE_COPY,
+        help="how files are placed in the folder: copy them, clone them (reflink), "
+        "or clone, hard link or copy them, whichever works first (link)",
+    )
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="write files with identical contents once and hard link the others to them",
+    )
+    parser.add_argument(
+        "--resize-images",
+        type=int,
+        metavar="MAX_SIZE",
+        help="resize and recompress images to at most MAX_SIZE pixels wide and high "
+        "(0 to only recompress them); requires Pillow",
+    )
+    parser.add_argument(
+        "--image-quality",
+        type=int,
+        default=TranscodeOptions.image_quality,
+        help="quality of recompressed JPEG and WebP images",
+    )
+    parser.add_argument(
+        "--audio-format",
+        help="convert audio files to this format (e.g. mp3) using ffmpeg",
+    )
+    parser.add_argument(
+        "--audio-bitrate",
+        default=TranscodeOptions.audio_bitrate,
+        help="bitrate of converted audio files",
+    )
+    parser.add_argument(
+        "--transcode-cache",
+        default=os.path.join(tempfile.gettempdir(), "media_exporter_transcode_cache"),
+        help="folder where converted files are cached for later exports",
+    )
+    parser.add_argument(
+        "--index", help="path of a media reference index to speed up repeated exports"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print what would be exported without writing anything",
+    )
+    parser.add_argument(
+        "--report",
+        help="write the list of files to export to this CSV or JSON file (by extension)",
+    )
+    parser.add_argument(
+        "--progress-interval",
+        type=float,
+        default=1.0,
+        help="minimum seconds between progress events",
+    )
+    return parser.parse_args(argv)
+
+
+def make_exporter(
+    col: Collection, args: argparse.Namespace, index: MediaReferenceIndex | None
+) -> MediaExporter:
+    exts = set(args.exts) if args.exts is not None else None
+    if args.search is not None:
+        return SearchMediaExporter(col, args.search, args.fields, exts, index)
+    dids = []
+    for name in args.deck or [args.deck_tree]:
+        did = col.decks.id_for_name(name)
+        if did is None:
+            raise ValueError(f"deck not found: {name}")
+        dids.append(DeckId(did))
+    if args.deck_tree is not None:
+        return MultiDeckMediaExporter.from_tree(col, dids[0], args.fields, exts, index)
+    if len(dids) > 1:
+        return MultiDeckMediaExporter(col, dids, args.fields, exts, index)
+    return DeckMediaExporter(col, dids[0], args.fields, exts, args.subfolders, index)
+
+
+def make_transcoder(args: argparse.Namespace) -> Transcoder | None:
+    if args.resize_images is None and args.audio_format is None:
+        return None
+    options = TranscodeOptions(
+        images=args.resize_images is not None,
+        image_max_size=args.resize_images or 0,
+        image_quality=args.image_quality,
+        audio=args.audio_format is not None,
+        audio_format=args.audio_format or TranscodeOptions.audio_format,
+        audio_bitrate=args.audio_bitrate,
+    )
+    transcoder = Transcoder(options, args.transcode_cache)
+    if options.images and not transcoder.images:
+        print(
+            "warning: Pillow is not installed; images won't be resized", file=sys.stderr
+        )
+    if options.audio and not transcoder.ffmpeg:
+        print(
+            "warning: ffmpeg was not found; audio won't be converted", file=sys.stderr
+        )
+    return transcoder
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    # Opening a path that doesn't exist would create an empty collection
+    if not os.path.isfile(args.collection):
+        print_event("error", message=f"collection not found: {args.collection}")
+        return 1
+    try:
+        col = Collection(args.collection)
+    except DBError as exc:
+        # Raised if the collection is open in Anki
+        print_event("error", message=f"can't open collection: {exc}")
+        return 1
+    index = MediaReferenceIndex(args.index) if args.index else None
+    transcoder = make_transcoder(args)
+    try:
+        try:
+            exporter = make_exporter(col, args, index)
+            # Searches are only run here, so invalid ones are reported like unknown decks
+            note_count = exporter.note_count
+        except (ValueError, SearchError) as exc:
+            print_event("error", message=str(exc))
+            return 1
+        print_event("start", notes=note_count)
+        start_time = time.time()
+        plan = None
+        if args.report or args.dry_run:
+            plan = exporter.plan()
+            if args.report:
+                plan.write_report(args.report)
+            if args.dry_run:
+                print_event(
+                    "plan", seconds=round(time.time() - start_time, 3), **plan.summary()
+                )
+                return 0
+        last_progress = 0.0
+        exported_count = 0
+
+        def on_progress(progress: ExportProgress) -> None:
+            nonlocal last_progress
+            if (
+                not progress.finished
+                and time.time() - last_progress < args.progress_interval
+            ):
+                return
+            last_progress = time.time()
+            eta = progress.eta
+            print_event(
+                "progress",
+                processed=progress.notes_done,
+                notes=progress.note_count,
+                files=progress.files_done,
+                total_files=progress.file_count,
+                bytes=progress.bytes_done,
+                total_bytes=progress.total_bytes,
+                bytes_per_second=round(progress.throughput),
+                eta=round(eta, 1) if eta is not None else None,
+            )
+
+        sink: ExportSink
+        if args.format == "folder":
+            sink = FolderSink(
+                args.dest,
+                incremental=args.incremental,
+                hashes=args.hashes,
+                link_mode=args.link_mode,
+                dedupe=args.dedupe,
+            )
+        else:
+            sink = make_archive_sink(args.dest, args.format)
+        if args.pipeline:
+            stats = asyncio.run(
+                export_async(
+                    exporter,
+                    sink,
+                    writers=args.workers,
+                    queue_size=args.queue_size,
+                    progress=on_progress,
+                    transcoder=transcoder,
+                )
+            )
+            exported_count = stats.counters["exported"]
+        else:
+            for exported_count, _ in exporter.export(
+                sink,
+                workers=args.workers,
+                progress=on_progress,
+                transcoder=transcoder,
+                plan=plan,
+            ):
+                pass
+            assert exporter.stats is not None
+            stats = exporter.stats
+        print_event(
+            "done",
+            notes=note_count,
+            exported=exported_count,
+            seconds=round(time.time() - start_time, 3),
+            stats=stats.to_dict(),
+        )
+        print(stats.summary(), file=sys.stderr)
+    finally:
+        if index is not None:
+            index.close()
+        if transcoder is not None:
+            transcoder.close()
+        col.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,75 +1,110 @@
 from __future__ import annotations
 
+import copy
+import itertools
 import os
 import re
-import shutil
+import threading
+import time
 from abc import ABC, abstractmethod
-from pathlib import Path
-from typing import Generator
+from array import array
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import AbstractContextManager, nullcontext
+from pathlib import Path, PurePosixPath
+from typing import (
+    Callable,
+    Generator,
+    Generic,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Sequence,
+    TypeVar,
+)
 
 from anki.collection import Collection, SearchNode
 from anki.decks import DeckId
-from anki.models import NotetypeDict, TemplateDict
-from anki.notes import Note
-from anki.utils import ids2str
-
-
-def gather_media_from_css(css: str) -> list[str]:
-    # Regular expression taken from the anki repo https://github.com/ankitects/anki/blob/c2b1ab5eb06935e93aea6af09a224a99f4b971f0/rslib/src/text.rs#L151
-    underscored_css_imports_pattern = re.compile(
-        r"""(?xi)
-        (?:@import\s+           # import statement with a bare
-            "(_[^"]*.css)"      # double quoted
-            |                   # or
-            '(_[^']*.css)'      # single quoted css filename
-        )
-        |
-        (?:url\(\s*             # a url function with a
-            "(_[^"]+)"          # double quoted
-            |                   # or
-            '(_[^']+)'          # single quoted
-            |                   # or
-            (_.+)               # unquoted filename
-        \s*\))
-    """
+from anki.models import NotetypeDict, NotetypeId, TemplateDict
+from anki.notes import Note, NoteId
+from anki.utils import ids2str, split_fields
+
+from .media_dir import MediaDirIndex
+from .media_index import MediaReferenceIndex
+from .plan import ExportPlan, PlannedFile
+from .scan import MediaScan, ReferenceResolver
+from .sinks import ExportSink, FolderSink
+from .stats import ExportProgress, ExportStats
+from .transcode import Transcoder
+
+# Number of notes read from the notes table per query
+NOTES_CHUNK_SIZE = 1000
+DEFAULT_COPY_WORKERS = 4
+# Maximum number of pending copies per worker before export() waits for them to finish
+COPY_QUEUE_SIZE_PER_WORKER = 8
+# Minimum seconds between calls of the progress callback of export()
+PROGRESS_INTERVAL = 0.1
+
+WriteT = TypeVar("WriteT")
+
+
+class NoteRow(NamedTuple):
+    """Plain note data read from the notes table."""
+
+    id: NoteId
+    mid: NotetypeId
+    fields: list[str]
+
+
+# Regular expression taken from the anki repo https://github.com/ankitects/anki/blob/c2b1ab5eb06935e93aea6af09a224a99f4b971f0/rslib/src/text.rs#L151
+UNDERSCORED_CSS_IMPORTS_PATTERN = re.compile(
+    r"""(?xi)
+    (?:@import\s+           # import statement with a bare
+        "(_[^"]*.css)"      # double quoted
+        |                   # or
+        '(_[^']*.css)'      # single quoted css filename
     )
+    |
+    (?:url\(\s*             # a url function with a
+        "(_[^"]+)"          # double quoted
+        |                   # or
+        '(_[^']+)'          # single quoted
+        |                   # or
+        (_.+)               # unquoted filename
+    \s*\))
+"""
+)
+
+# Regular expression taken from the anki repo https://github.com/ankitects/anki/blob/c2b1ab5eb06935e93aea6af09a224a99f4b971f0/rslib/src/text.rs#L169
+UNDERSCORED_REFERENCES_PATTERN = re.compile(
+    r"""(?x)
+    \[sound:(_[^]]+)\]  # a filename in an Anki sound tag
+    |
+    "(_[^"]+)"          # a double quoted
+    |
+    '(_[^']+)'          # single quoted string
+    |
+    \b(?:src|data)      # a 'src' or 'data' attribute
+    =
+    (_[^ >]+)           # an unquoted value
+"""
+)
+
+# Media of notetypes keyed by notetype ID and modification time
+_notetype_media_cache: dict[tuple[NotetypeId, int], list[str]] = {}
+
+
+def _gather_underscored_media(pattern: re.Pattern, text: str) -> list[str]:
+    # Only one group of the patterns matches at a time
+    return [match.group(match.lastindex) for match in pattern.finditer(text)]
 
-    media_files = []
 
-    matches = underscored_css_imports_pattern.findall(css)
-    for match in matches:
-        for group in match:
-            if group and group.startswith("_"):
-                media_files.append(group)
-
-    return media_files
+def gather_media_from_css(css: str) -> list[str]:
+    return _gather_underscored_media(UNDERSCORED_CSS_IMPORTS_PATTERN, css)
 
 
 def gather_media_from_template_side(template_side: str) -> list[str]:
-    # Regular expression taken from the anki repo https://github.com/ankitects/anki/blob/c2b1ab5eb06935e93aea6af09a224a99f4b971f0/rslib/src/text.rs#L169
-    underscored_references_pattern = re.compile(
-        r"""(?x)
-        \[sound:(_[^]]+)\]  # a filename in an Anki sound tag
-        |
-        "(_[^"]+)"          # a double quoted
-        |
-        '(_[^']+)'          # single quoted string
-        |
-        \b(?:src|data)      # a 'src' or 'data' attribute
-        =
-        (_[^ >]+)           # an unquoted value
-    """
-    )
-
-    media_files = []
-
-    matches = underscored_references_pattern.findall(template_side)
-    for match in matches:
-        for group in match:
-            if group and group.startswith("_"):
-                media_files.append(group)
-
-    return media_files
+    return _gather_underscored_media(UNDERSCORED_REFERENCES_PATTERN, template_side)
 
 
 def gather_media_from_template(template: TemplateDict) -> list[str]:
@@ -82,122 +117,664 @@ def gather_media_from_template(template: TemplateDict) -> list[str]:
     return media_files
 
 
+def files_in_str(col: Collection, mid: NotetypeId, string: str) -> list[str]:
+    func = getattr(col.media, "files_in_str", None)
+    if not func:
+        func = col.media.filesInStr  # type: ignore
+    return func(mid, string)
+
+
 def get_note_media(col: Collection, note: Note, fields: list[str] | None) -> list[str]:
     if fields is not None:
         matched_fields = [note[field] for field in fields if field in note]
     else:
         matched_fields = note.fields
-    flds = "".join(matched_fields)
-    files_in_str = getattr(col.media, "files_in_str", None)
-    if not files_in_str:
-        files_in_str = col.media.filesInStr  # type: ignore
-    return files_in_str(note.mid, flds)
+    return files_in_str(col, note.mid, "".join(matched_fields))
+
+
+def may_reference_media(text: str) -> bool:
+    """
+    Whether `text` might contain a media reference. All references Anki recognizes
+    are HTML tags or bracketed tags such as `[sound:...]` and `[latex]`.
+    """
+    return "<" in text or "[" in text
+
+
+def get_fields_media(
+    col: Collection, mid: NotetypeId, fields: list[str]
+) -> list[list[str]]:
+    """
+    Return the media files referenced in each of `fields`.
+    Only fields that might contain a media reference are passed to the backend, one call each.
+    """
+    return [
+        files_in_str(col, mid, field) if may_reference_media(field) else []
+        for field in fields
+    ]
 
 
 def get_notetype_media(notetype: NotetypeDict) -> list[str]:
-    css_media = gather_media_from_css(notetype["css"])
+    """
+    Return the media files referenced in the CSS and templates of `notetype`, without duplicates.
+    Results are cached until the notetype is modified.
+    """
+    key = (notetype["id"], notetype["mod"])
+    media = _notetype_media_cache.get(key)
+    if media is None:
+        media = gather_media_from_css(notetype["css"])
+        for template in notetype["tmpls"]:
+            # Template sides are scanned separately so that matches can't span them
+            media.extend(gather_media_from_template(template))
+        media = list(dict.fromkeys(media))
+        _notetype_media_cache[key] = media
+    return list(media)
+
 
-    template_media = []
-    for template in notetype["tmpls"]:
-        template_media.extend(gather_media_from_template(template))
+class WrittenFile(NamedTuple):
+    """A file written by `ExportWriter.write()`."""
 
-    return css_media + template_media
+    name: str
+    src_path: str
+    stat: Optional[os.stat_result]
+
+
+class ExportWriter:
+    """
+    Writes the files of an export to `sink`, converting them with `transcoder` first if given.
+    Source files are stat'd through `files` if given, so it's done once per file however many copies are written.
+    Can be used from multiple threads even if the sink doesn't support concurrent writes.
+    """
+
+    def __init__(
+        self,
+        sink: ExportSink,
+        stats: ExportStats,
+        transcoder: Transcoder | None = None,
+        files: MediaDirIndex | None = None,
+    ) -> None:
+        self.sink = sink
+        self.stats = stats
+        self.transcoder = transcoder
+        self.files = files
+        self._sink_lock: AbstractContextManager = (
+            nullcontext() if sink.concurrent else threading.Lock()
+        )
+
+    def write(self, src_path: str, folder: Path, filename: str) -> WrittenFile | None:
+        """Write `src_path` as `filename` in `folder`. Returns None if it doesn't exist."""
+        stats = self.stats
+        stat = self.files.stat(filename) if self.files is not None else None
+        if self.transcoder is not None:
+            with stats.timed("transcode"):
+                try:
+                    src_path, filename, status = self.transcoder.transcode(
+                        src_path, filename, self.files
+                    )
+                    if status is not None:
+                        # Written from the converted file instead
+                        stat = None
+                    stats.count(
+                        transcoded=int(status == "converted"),
+                        transcode_cached=int(status == "cached"),
+                    )
+                except self.transcoder.errors:
+                    stats.count(transcode_failed=1)
+        name = (folder / filename).as_posix()
+        with stats.timed("write"), self._sink_lock:
+            if self.sink.write(src_path, name, stat):
+                return WrittenFile(name, src_path, stat)
+            return None
+
+    def link(self, first: WrittenFile | None, folder: Path) -> WrittenFile | None:
+        """Write a copy of `first`, the result of an earlier `write()`, to `folder`."""
+        if first is None:
+            return None
+        name = (folder / PurePosixPath(first.name).name).as_posix()
+        with self.stats.timed("write"), self._sink_lock:
+            if self.sink.link(first.src_path, name, first.name, first.stat):
+                return first._replace(name=name)
+            return None
+
+
+def worker_count(workers: int, sink: ExportSink, transcoder: Transcoder | None) -> int:
+    """Return the number of files to write to `sink` at once, given the number of `workers` requested."""
+    if transcoder is not None:
+        # Writers wait for conversions, so there should be enough of them to keep the transcoder busy
+        workers = max(workers, transcoder.workers)
+    return max(1, workers) if sink.concurrent or transcoder else 1
+
+
+class ProgressReporter:
+    """
+    Calls `callback` with `state` at most every `PROGRESS_INTERVAL` seconds, and once the export finishes,
+    setting the seconds elapsed since the reporter was created.
+    """
+
+    def __init__(
+        self, callback: Callable[[ExportProgress], None] | None, state: ExportProgress
+    ) -> None:
+        self.callback = callback
+        self.state = state
+        self.start = time.perf_counter()
+        self._last = 0.0
+
+    def __call__(self, finished: bool = False) -> None:
+        now = time.perf_counter()
+        if self.callback is None or (
+            not finished and now - self._last < PROGRESS_INTERVAL
+        ):
+            return
+        self._last = now
+        self.state.elapsed = now - self.start
+        self.state.finished = finished
+        self.callback(self.state)
+
+
+class FirstWrites(Generic[WriteT]):
+    """
+    Pending or finished writes of the first copy of each file, to link its other copies to.
+    Writes are only kept if `link_copies` is True, i.e. some files are exported to several folders.
+    """
+
+    def __init__(self, link_copies: bool) -> None:
+        self.link_copies = link_copies
+        self._writes: dict[str, WriteT] = {}
+
+    @classmethod
+    def for_plan(cls, plan: ExportPlan) -> FirstWrites[WriteT]:
+        return cls(any(not planned.first for planned in plan.files))
+
+    def link_to(self, filename: str, first: bool) -> WriteT | None:
+        """Return the write to link a copy of `filename` to, or None if it's the `first` copy."""
+        return None if first else self._writes.get(filename)
+
+    def add(self, filename: str, write: WriteT) -> None:
+        """Record the write of the first copy of `filename`."""
+        if self.link_copies:
+            self._writes[filename] = write
 
 
 class MediaExporter(ABC):
     """Abstract media exporter."""
 
     def __init__(
-        self, col: Collection, fields: list[str] | None = None, exts: set | None = None
+        self,
+        col: Collection,
+        fields: list[str] | None = None,
+        exts: set | None = None,
+        index: MediaReferenceIndex | None = None,
     ) -> None:
         self.col = col
         self.fields = fields
         self.exts = exts
-        self._notes: list[Note] = []
-        self._media_lists: list[list[str]] = []
+        self.index = index
+        self._scan = MediaScan(col.media.dir())
+        self._notetypes: dict[NotetypeId, NotetypeDict] = {}
+        self._field_indices: dict[NotetypeId, list[int]] = {}
+        # Timings and counters of the scan, shared with copies like the scan itself
+        self._scan_stats = ExportStats()
+        # Stats of the last export
+        self.stats: ExportStats | None = None
 
     @property
     @abstractmethod
-    def notes(self) -> list[Note]:
-        return self._notes
+    def note_ids(self) -> Sequence[NoteId]:
+        """IDs of the notes to export media from."""
 
-    def folder_for_note(self, base_folder: Path, note: Note) -> Path:
+    @property
+    def note_count(self) -> int:
+        return len(self.note_ids)
+
+    def with_filters(self, fields: list[str] | None, exts: set | None) -> MediaExporter:
+        """Return a copy of this exporter using different filters and sharing its scan and notetypes."""
+        exporter = copy.copy(self)
+        exporter.fields = fields
+        exporter.exts = exts
+        exporter._field_indices = {}
+        exporter.stats = None
+        return exporter
+
+    @property
+    def name(self) -> str:
+        """Name used for archives of the exported media."""
+        return "media"
+
+    def folder_for_note(self, base_folder: Path, nid: NoteId) -> Path:
         return base_folder
 
+    def note_folders(
+        self, nid: NoteId | None, mid: NotetypeId
+    ) -> Sequence[tuple[int, Path]]:
+        """
+        Return the folders, relative to the export's root, that the media of note `nid`
+        (or of notetype `mid` if `nid` is None) is exported to, each with the index of its group.
+        Each file is exported once per group, to the folder of the first note referencing it;
+        see `folder_groups`.
+        """
+        if nid is None:
+            return [(0, Path())]
+        return [(0, self.folder_for_note(Path(), nid))]
+
+    @property
+    def folder_groups(self) -> int:
+        """
+        Number of groups of folders returned by `note_folders()`.
+        Copies of a file in later groups are linked to its first copy where the sink supports it.
+        """
+        return 1
+
+    def notetype(self, mid: NotetypeId) -> NotetypeDict:
+        """Return notetype `mid`, fetching it from the collection only once per scan."""
+        notetype = self._notetypes.get(mid)
+        if notetype is None:
+            notetype = self._notetypes[mid] = self.col.models.get(mid)
+        return notetype
+
+    def included_field_indices(self, mid: NotetypeId) -> list[int]:
+        """Return the indices of the fields of notetype `mid` included in the export."""
+        if mid not in self._field_indices:
+            field_names = [field["name"] for field in self.notetype(mid)["flds"]]
+            if self.fields is None:
+                indices = list(range(len(field_names)))
+            else:
+                indices = [
+                    field_names.index(field)
+                    for field in self.fields
+                    if field in field_names
+                ]
+            self._field_indices[mid] = indices
+        return self._field_indices[mid]
+
+    def note_rows(
+        self, note_ids: Sequence[NoteId] | None = None
+    ) -> Generator[NoteRow, None, None]:
+        """Read the notes in `note_ids` (`self.note_ids` by default) from the notes table in chunks."""
+        if note_ids is None:
+            note_ids = self.note_ids
+        for start in range(0, len(note_ids), NOTES_CHUNK_SIZE):
+            chunk = note_ids[start : start + NOTES_CHUNK_SIZE]
+            rows = {
+                nid: (mid, flds)
+                for nid, mid, flds in self.col.db.execute(
+                    f"select id, mid, flds from notes where id in {ids2str(chunk)}"
+                )
+            }
+            # Preserve the order of `self.note_ids`
+            for nid in chunk:
+                if nid not in rows:
+                    continue
+                mid, flds = rows[nid]
+                yield NoteRow(nid, mid, split_fields(flds))
+
+    def _indexed_note_media(
+        self, note_ids: Sequence[NoteId]
+    ) -> Generator[tuple[NoteId, NotetypeId, list[list[str]]], None, None]:
+        """Like `_note_media()`, but only parse notes that changed since they were added to `self.index`."""
+        stats = self._scan_stats
+        checked_mids: set[NotetypeId] = set()
+        for start in range(0, len(note_ids), NOTES_CHUNK_SIZE):
+            chunk = note_ids[start : start + NOTES_CHUNK_SIZE]
+            with stats.timed("read_notes"):
+                notes = [
+                    (NoteId(nid), NotetypeId(mid), mod, usn)
+                    for nid, mid, mod, usn in self.col.db.execute(
+                        f"select id, mid, mod, usn from notes where id in {ids2str(chunk)}"
+                    )
+                ]
+            with stats.timed("index"):
+                for mid in {note[1] for note in notes} - checked_mids:
+                    self.index.check_notetype(self.notetype(mid))
+                    checked_mids.add(mid)
+                field_media = self.index.get_many(notes)
+            stats.count(notes_cached=len(field_media))
+            stale = [note for note in notes if note[0] not in field_media]
+            if stale:
+                stale_mids = {nid: (mid, mod, usn) for nid, mid, mod, usn in stale}
+                entries = []
+                with stats.timed("read_notes"):
+                    stale_rows = self.col.db.execute(
+                        f"select id, flds from notes where id in {ids2str(stale_mids)}"
+                    )
+                with stats.timed("parse_media"):
+                    for nid, flds in stale_rows:
+                        mid, mod, usn = stale_mids[nid]
+                        media = get_fields_media(self.col, mid, split_fields(flds))
+                        field_media[nid] = media
+                        entries.append((nid, mid, mod, usn, media))
+                with stats.timed("index"):
+                    self.index.put_many(entries)
+            mids = {note[0]: note[1] for note in notes}
+            # Preserve the order of `self.note_ids`
+            for nid in chunk:
+                if nid in mids:
+                    yield nid, mids[nid], field_media[nid]
+
+    def _note_media(
+        self, note_ids: Sequence[NoteId] | None = None
+    ) -> Generator[tuple[NoteId, NotetypeId, list[list[str]]], None, None]:
+        """Yield the ID, notetype ID and media files of each field of each note in `note_ids` (all by default)."""
+        if note_ids is None:
+            note_ids = self.note_ids
+        if self.index is not None:
+            yield from self._indexed_note_media(note_ids)
+            return
+        stats = self._scan_stats
+        rows = self.note_rows(note_ids)
+        while True:
+            with stats.timed("read_notes"):
+                row = next(rows, None)
+            if row is None:
+                break
+            with stats.timed("parse_media"):
+                field_media = get_fields_media(self.col, row.mid, row.fields)
+            yield row.id, row.mid, field_media
+
+    def scan_notes(self, resume: bool = False) -> Iterator[NoteId]:
+        """
+        Start gathering the media of all fields of the notes into `self.scan`. Returns an iterator that
+        adds one note at a time, yielding its ID, then completes the scan with the media of their notetypes.
+        If `resume` is True, a partial scan, e.g. one interrupted by closing the export dialog,
+        is continued without scanning its notes again.
+        """
+        scan = self._scan
+        if resume and scan.note_ids:
+            scanned = set(scan.note_ids)
+            return self._scan_notes(
+                [nid for nid in self.note_ids if nid not in scanned]
+            )
+        scan.clear()
+        self._notetypes.clear()
+        self._scan_stats.clear()
+        return self._scan_notes(None)
+
+    def _scan_notes(
+        self, note_ids: Sequence[NoteId] | None
+    ) -> Generator[NoteId, None, None]:
+        scan = self._scan
+        stats = self._scan_stats
+        for nid, mid, field_media in self._note_media(note_ids):
+            scan.add_note(nid, mid, field_media)
+            yield nid
+        with stats.timed("notetype_media"):
+            for mid in {NotetypeId(mid) for mid in scan.note_mids}:
+                scan.add_notetype(mid, get_notetype_media(self.notetype(mid)))
+        stats.count(notes=len(scan.note_ids))
+        scan.complete = True
+
+    def scan_iter(self) -> Generator[MediaScan, None, None]:
+        """
+        Gather the media of all fields of the notes and their notetypes into `self.scan`,
+        yielding the partial scan after each note.
+        """
+        scan = self._scan
+        if not scan.complete:
+            for _ in self.scan_notes():
+                yield scan
+        yield scan
+
+    @property
+    def scan(self) -> MediaScan:
+        """The media scan shared by this exporter and its copies returned by `with_filters()`."""
+        if not self._scan.complete:
+            for _ in self.scan_iter():
+                pass
+        return self._scan
+
+    @property
+    def partial_scan(self) -> MediaScan:
+        """The media scan as it is, without completing it first."""
+        return self._scan
+
+    @property
+    def scan_stats(self) -> ExportStats:
+        """Timings and counters of the scan."""
+        return self._scan_stats
+
+    def note_media_refs(
+        self, start: int = 0
+    ) -> Generator[tuple[NoteId, NotetypeId, array], None, None]:
+        """
+        Yield the ID, notetype ID and the IDs of the included media files of each note scanned so far,
+        from the note at index `start` in the scan. Notes without included fields are skipped.
+        """
+        for nid, mid, field_refs in self._scan.note_refs(
+            self.included_field_indices, start
+        ):
+            if not field_refs:
+                continue
+            if len(field_refs) == 1:
+                yield nid, mid, field_refs[0]
+            else:
+                refs = array("I")
+                for field in field_refs:
+                    refs.extend(field)
+                yield nid, mid, refs
+
+    def _note_media_refs(
+        self,
+    ) -> Generator[tuple[NoteId | None, NotetypeId, array], None, None]:
+        """
+        Yield the ID of each note (None for notetype media), its notetype ID
+        and the IDs of its media files in the scan.
+        """
+        scan = self.scan
+        notetypes_in_selection = set()
+        for nid, mid, refs in self.note_media_refs():
+            # Gather notetypes in selected notes without duplicates
+            notetypes_in_selection.add(mid)
+            yield nid, mid, refs
+
+        for mid in notetypes_in_selection:
+            yield None, mid, scan.notetype_media[mid]
+
+    def resolver(self) -> ReferenceResolver:
+        """Return a resolver of the references to export from the scan."""
+        return ReferenceResolver(self._scan, self.exts, self.folder_groups)
+
+    def _note_media_lists(
+        self,
+    ) -> Generator[tuple[NoteId | None, list[str]], None, None]:
+        """Yield the ID of each note (None for notetype media) and its media files."""
+        names = self.scan.names
+        for nid, _, refs in self._note_media_refs():
+            yield nid, [names[i] for i in refs]
+
     @property
     def media_lists(self) -> Generator[list[str], None, None]:
         """Return a generator that yields a list of media files for each note."""
-        if self._media_lists:
-            yield from self._media_lists
-        else:
-            notetypes_in_selection = set()
-            for note in self.notes:
-                # Gather notetypes in selected notes without duplicates
-                notetypes_in_selection.add(note.note_type()["name"])
-
-                media = get_note_media(self.col, note, self.fields)
-                self._media_lists.append(media)
-                yield media
-
-            get_notetype_by_name = getattr(self.col.models, "by_name", None)
-            if not get_notetype_by_name:
-                get_notetype_by_name = self.col.models.byName  # type: ignore[attr-defined]
-            for notetype_name in notetypes_in_selection:
-                notetype = get_notetype_by_name(notetype_name)
-                media = get_notetype_media(notetype)
-                self._media_lists.append(media)
-                yield media
+        for _, media in self._note_media_lists():
+            yield media
 
     def all_extensions(self) -> set[str]:
-        exts = set()
-        for media_list in self.media_lists:
-            for filename in media_list:
-                ext = os.path.splitext(filename)[1][1:]
-                exts.add(ext)
-        return exts
+        scan = self.scan
+        if self.fields is None:
+            return set(scan.extensions)
+        used = bytearray(len(scan.names))
+        for _, _, refs in self._note_media_refs():
+            for name_id in refs:
+                used[name_id] = 1
+        return scan.names_extensions(used)
+
+    def plan(self) -> ExportPlan:
+        """Work out the files `export()` would write and how, without writing anything."""
+        scan = self.scan
+        names = scan.names
+        files = scan.files
+        plan = ExportPlan(note_count=self.note_count)
+        resolver = self.resolver()
+        # Number of notes referencing each file
+        note_counts = array("I", [0]) * len(names)
+        note_index = -1
+        for nid, mid, refs in self._note_media_refs():
+            if nid is not None:
+                note_index += 1
+                for name_id in set(refs):
+                    note_counts[name_id] += 1
+            plan.references += len(refs)
+            for group, folder in self.note_folders(nid, mid):
+                for name_id, src_path, first in resolver.resolve(refs, group):
+                    filename = names[name_id]
+                    plan.files.append(
+                        PlannedFile(
+                            max(note_index, 0),
+                            folder,
+                            filename,
+                            src_path,
+                            files.size(filename) or 0,
+                            first,
+                        )
+                    )
+        plan.duplicates = resolver.duplicates
+        plan.filtered = resolver.filtered
+        plan.missing = resolver.missing
+        plan.shared = {
+            names[name_id]: count
+            for name_id, count in enumerate(note_counts)
+            if count > 1
+            and (resolver.resolved[name_id] or resolver.missing_ids[name_id])
+        }
+        return plan
+
+    def notetype_ids(self) -> list[NotetypeId]:
+        """Return the IDs of the notetypes of the notes, without duplicates."""
+        if self._scan.complete:
+            return [NotetypeId(mid) for mid in dict.fromkeys(self._scan.note_mids)]
+        mids: dict[NotetypeId, None] = {}
+        note_ids = self.note_ids
+        for start in range(0, len(note_ids), NOTES_CHUNK_SIZE):
+            chunk = note_ids[start : start + NOTES_CHUNK_SIZE]
+            mids.update(
+                dict.fromkeys(
+                    self.col.db.list(
+                        f"select distinct mid from notes where id in {ids2str(chunk)}"
+                    )
+                )
+            )
+        return list(mids)
 
     def all_fields(self) -> list[str]:
-        fields = self.col.db.list(
-            "select distinct name from fields where ntid in (select mid from notes where id in %s)"
-            % ids2str(note.id for note in self.notes)
-        )
-        return fields
-
+        """Return the names of the fields of the notes' notetypes, without duplicates."""
+        fields: dict[str, None] = {}
+        for mid in self.notetype_ids():
+            for field in self.notetype(mid)["flds"]:
+                fields[field["name"]] = None
+        return list(fields)
+
+    # pylint: disable=too-many-locals
     def export(
-        self, base_folder: Path | str
-    ) -> Generator[tuple[int, list[str]], None, None]:
+        self,
+        dest: Path | str | ExportSink,
+        workers: int = DEFAULT_COPY_WORKERS,
+        incremental: bool = True,
+        hashes: bool = False,
+        progress: Callable[[ExportProgress], None] | None = None,
+        transcoder: Transcoder | None = None,
+        plan: ExportPlan | None = None,
+    ) -> Generator[tuple[int, list[str]], None, ExportStats]:
         """
-        Export media files in `self.notes` to `base_folder`,
+        Export media files in `self.note_ids` to `dest`, a folder or a sink such as an archive,
         including only files that has extensions in `self.exts` if it's not None.
+        Files are written by a pool of `workers` threads if the sink supports it.
+        When exporting to a folder, `incremental` and `hashes` are passed to `FolderSink`.
+        The sink is closed when the export finishes.
+        `progress` is called with the progress of the export at most every `PROGRESS_INTERVAL` seconds
+        and once the export finishes, from the thread consuming the generator.
+        If `transcoder` is given, files are converted by it before being written; files that fail to
+        convert are exported as is. Conversions run in parallel even if the sink doesn't support concurrent writes.
+        The files to write are taken from `plan` if given, which must come from `self.plan()`,
+        so a dry run can be followed by the export without scanning again.
         Returns a generator that yields the total media files exported so far and filenames as they are exported.
+        Closing the generator cancels writes that haven't started yet.
+        Timings and counters of the scan and export are returned by the generator and stored in `self.stats`.
         """
-        base_folder = Path(base_folder)
-        media_dir = self.col.media.dir()
-        seen = set()
-        exported = set()
-        for i, filenames in enumerate(self.media_lists):
-            folder = (
-                self.folder_for_note(base_folder, self.notes[i])
-                if len(self.notes) > i
-                else base_folder
-            )
-            folder.mkdir(exist_ok=True, parents=True)
-            for filename in filenames:
-                if filename in seen:
-                    continue
-                seen.add(filename)
-                if (
-                    self.exts is not None
-                    and os.path.splitext(filename)[1][1:] not in self.exts
-                ):
-                    continue
-                src_path = os.path.join(media_dir, filename)
-                if not os.path.exists(src_path):
-                    continue
-                dest_path = os.path.join(folder, filename)
-                shutil.copyfile(src_path, dest_path)
-                exported.add(filename)
-            yield len(exported), filenames
+        if isinstance(dest, ExportSink):
+            sink = dest
+        else:
+            sink = FolderSink(dest, incremental, hashes)
+        workers = worker_count(workers, sink, transcoder)
+        max_pending = workers * COPY_QUEUE_SIZE_PER_WORKER
+        # Finish the scan first, so its timings are included in the stats
+        if not self._scan.complete:
+            for _ in self.scan_iter():
+                pass
+        stats = self.stats = sink.stats = self._scan_stats.copy()
+        if plan is None:
+            with stats.timed("plan"):
+                plan = self.plan()
+        stats.count(
+            references=plan.references,
+            duplicates=plan.duplicates,
+            filtered=plan.filtered,
+            missing=len(plan.missing),
+        )
+        first_writes: FirstWrites[Future[WrittenFile | None]] = FirstWrites.for_plan(
+            plan
+        )
+        exported_count = 0
+        pending: deque[tuple[Future[WrittenFile | None], int]] = deque()
+        state = ExportProgress(
+            0, plan.note_count, 0, plan.file_count, 0, plan.total_bytes, 0
+        )
+        writer = ExportWriter(sink, stats, transcoder, self._scan.files)
+
+        def link(
+            first_write: Future[WrittenFile | None], folder: Path
+        ) -> WrittenFile | None:
+            # Submitted after the first write, so the latter is already running
+            return writer.link(first_write.result(), folder)
+
+        def finish_write() -> None:
+            nonlocal exported_count
+            future, size = pending.popleft()
+            with stats.timed("wait"):
+                written = future.result() is not None
+            exported_count += written
+            stats.count(exported=int(written), missing=int(not written))
+            state.files_done += 1
+            state.bytes_done += size
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        start = time.perf_counter()
+        report_progress = ProgressReporter(progress, state)
+        try:
+            for note_index, note_files in itertools.groupby(
+                plan.files, key=lambda planned: planned.note_index
+            ):
+                filenames = []
+                for planned in note_files:
+                    if len(pending) >= max_pending:
+                        finish_write()
+                    first_write = first_writes.link_to(planned.filename, planned.first)
+                    if first_write is None:
+                        future = executor.submit(
+                            writer.write,
+                            planned.src_path,
+                            planned.folder,
+                            planned.filename,
+                        )
+                        first_writes.add(planned.filename, future)
+                        size = planned.size
+                    else:
+                        future = executor.submit(link, first_write, planned.folder)
+                        size = 0
+                    pending.append((future, size))
+                    filenames.append(planned.filename)
+                while pending and pending[0][0].done():
+                    finish_write()
+                sink.flush()
+                state.notes_done = min(note_index + 1, plan.note_count)
+                report_progress()
+                yield exported_count, filenames
+            while pending:
+                finish_write()
+                report_progress()
+            report_progress(finished=True)
+            yield exported_count, []
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            sink.close()
+            stats.phases["export"] = time.perf_counter() - start
+        return stats
 
 
 class NoteMediaExporter(MediaExporter):
@@ -211,15 +788,63 @@ class NoteMediaExporter(MediaExporter):
         exts: set | None = None,
     ):
         super().__init__(col, fields, exts)
-        self._notes = notes
+        self.notes = notes
+
+    @property
+    def note_ids(self) -> list[NoteId]:
+        return [note.id for note in self.notes]
+
+    def notetype_ids(self) -> list[NotetypeId]:
+        return list(dict.fromkeys(note.mid for note in self.notes))
+
+    def note_rows(
+        self, note_ids: Sequence[NoteId] | None = None
+    ) -> Generator[NoteRow, None, None]:
+        # The notes might have unsaved changes (e.g. in the editor), so we use them directly
+        included = set(note_ids) if note_ids is not None else None
+        for note in self.notes:
+            if included is None or note.id in included:
+                yield NoteRow(note.id, note.mid, note.fields)
+
+
+class SearchMediaExporter(MediaExporter):
+    """Exporter for notes matching a search string or a list of note IDs, loaded lazily in pages."""
+
+    def __init__(
+        self,
+        col: Collection,
+        search: str | Sequence[NoteId],
+        fields: list[str] | None = None,
+        exts: set | None = None,
+        index: MediaReferenceIndex | None = None,
+    ):
+        super().__init__(col, fields, exts, index)
+        self.search = search
+        self._note_ids: list[NoteId] | None = None
 
     @property
-    def notes(self) -> list[Note]:
-        return self._notes
+    def note_ids(self) -> list[NoteId]:
+        if self._note_ids is None:
+            if isinstance(self.search, str):
+                self._note_ids = list(self.col.find_notes(self.search))
+            else:
+                self._note_ids = list(self.search)
+        return self._note_ids
+
+    @property
+    def notes(self) -> Iterator[Note]:
+        """Iterate over the notes, loading them from the collection one page at a time."""
+        note_ids = self.note_ids
+        for start in range(0, len(note_ids), NOTES_CHUNK_SIZE):
+            page = [
+                self.col.get_note(nid)
+                for nid in note_ids[start : start + NOTES_CHUNK_SIZE]
+            ]
+            yield from page
 
 
 # pylint: disable=too-many-arguments
-class DeckMediaExporter(MediaExporter):
+class DeckMediaExporter(SearchMediaExporter):
     "Exporter for all media in a deck."
 
     def __init__(
@@ -229,34 +854,134 @@ class DeckMediaExporter(MediaExporter):
         fields: list[str] | None = None,
         exts: set | None = None,
         organize_into_subfolders: bool = False,
+        index: MediaReferenceIndex | None = None,
     ):
-        super().__init__(col, fields, exts)
+        search = col.build_search_string(SearchNode(deck=col.decks.name(did)))
+        super().__init__(col, search, fields, exts, index)
         self.did = did
         self._organize_into_subfolders = organize_into_subfolders
+        self._note_decks: dict[NoteId, DeckId] | None = None
+        self._deck_folder_names: dict[DeckId, str] = {}
+
+    @property
+    def name(self) -> str:
+        return self.col.decks.name(self.did).replace("::", "__")
 
     @property
-    def notes(self) -> list[Note]:
-        if self._notes:
-            return self._notes
-        if self.fields is not None and len(self.fields) == 0:
-            return []
-        search_terms = [SearchNode(deck=self.col.decks.name(self.did))]
-        if self.fields is not None:
-            or_terms = []
-            for field in self.fields:
-                or_terms.append(SearchNode(field_name=field))
-            search_terms.append(self.col.group_searches(*or_terms, joiner="OR"))
-        search = self.col.build_search_string(*search_terms)
-        for nid in self.col.find_notes(search):
-            self._notes.append(self.col.get_note(nid))
-        return self._notes
-
-    def folder_for_note(self, base_folder: Path, note: Note) -> Path:
+    def note_decks(self) -> dict[NoteId, DeckId]:
+        """Map each note in the deck to the deck of its first card."""
+        if self._note_decks is None:
+            dids = ids2str(self.col.decks.deck_and_child_ids(self.did))
+            # SQLite takes the bare did column from the row with the minimum ord
+            self._note_decks = {
+                nid: did
+                for nid, did, _ in self.col.db.execute(
+                    f"""select nid, did, min(ord) from cards where nid in
+                    (select nid from cards where did in {dids} or odid in {dids})
+                    group by nid"""
+                )
+            }
+        return self._note_decks
+
+    def folder_for_note(self, base_folder: Path, nid: NoteId) -> Path:
         if not self._organize_into_subfolders:
             return base_folder
-        did = self.col.db.scalar(
-            "select did from cards where id = ?", note.card_ids()[0]
-        )
-        deck_name = self.col.decks.name(did).replace("::", "__")
+        did = self.note_decks.get(nid)
+        if did is None:
+            return base_folder
+        deck_name = self._deck_folder_names.get(did)
+        if deck_name is None:
+            deck_name = self.col.decks.name(did).replace("::", "__")
+            self._deck_folder_names[did] = deck_name
 
         return base_folder / Path(deck_name)
+
+
+class MultiDeckMediaExporter(MediaExporter):
+    """
+    Exporter for several decks at once, writing the media of each deck to a folder named after it.
+    Each deck includes its subdecks, except the ones that are exported too.
+    Notes are scanned once, and files used by several decks are linked to their first copy where the sink supports it.
+    """
+
+    def __init__(
+        self,
+        col: Collection,
+        dids: Sequence[DeckId],
+        fields: list[str] | None = None,
+        exts: set | None = None,
+        index: MediaReferenceIndex | None = None,
+    ):
+        super().__init__(col, fields, exts, index)
+        self.dids = list(dict.fromkeys(dids))
+        self._deck_names = [col.decks.name(did) for did in self.dids]
+        self._folders = [Path(name.replace("::", "__")) for name in self._deck_names]
+        self._note_ids: list[NoteId] | None = None
+        # Indices in `self.dids` of the decks of each note and each notetype
+        self._note_groups: dict[NoteId, list[int]] = {}
+        self._notetype_groups: dict[NotetypeId, list[int]] | None = None
+
+    @classmethod
+    def from_tree(
+        cls,
+        col: Collection,
+        root_did: DeckId,
+        fields: list[str] | None = None,
+        exts: set | None = None,
+        index: MediaReferenceIndex | None = None,
+    ) -> MultiDeckMediaExporter:
+        """Return an exporter for deck `root_did` and each of its subdecks, each to its own folder."""
+        return cls(col, col.decks.deck_and_child_ids(root_did), fields, exts, index)
+
+    @property
+    def folder_groups(self) -> int:
+        return len(self.dids)
+
+    def _load_notes(self) -> None:
+        # Assign each deck to the closest exported deck, so parents go first
+        deck_groups: dict[DeckId, int] = {}
+        for group in sorted(
+            range(len(self.dids)), key=lambda i: self._deck_names[i].count("::")
+        ):
+            for did in self.col.decks.deck_and_child_ids(self.dids[group]):
+                deck_groups[did] = group
+        dids = ids2str(deck_groups)
+        note_groups: dict[NoteId, list[int]] = {}
+        for nid, did, odid in self.col.db.execute(
+            f"select nid, did, odid from cards where did in {dids} or odid in {dids} order by nid"
+        ):
+            # Cards in filtered decks belong to their original deck
+            group = deck_groups.get(odid or did)
+            if group is None:
+                continue
+            groups = note_groups.setdefault(nid, [])
+            if group not in groups:
+                groups.append(group)
+        self._note_groups = note_groups
+        self._note_ids = list(note_groups)
+
+    @property
+    def note_ids(self) -> list[NoteId]:
+        if self._note_ids is None:
+            self._load_notes()
+            assert self._note_ids is not None
+        return self._note_ids
+
+    def note_folders(
+        self, nid: NoteId | None, mid: NotetypeId
+    ) -> Sequence[tuple[int, Path]]:
+        if nid is not None:
+            groups = self._note_groups.get(nid, [])
+        else:
+            if self._notetype_groups is None:
+                notetype_groups: dict[NotetypeId, list[int]] = {}
+                # The scan might still be in progress in the export pipeline, after all notes were added
+                scan = self._scan
+                for note_id, note_mid in zip(scan.note_ids, scan.note_mids):
+                    mid_groups = notetype_groups.setdefault(NotetypeId(note_mid), [])
+                    for group in self._note_groups.get(NoteId(note_id), []):
+                        if group not in mid_groups:
+                            mid_groups.append(group)
+                self._notetype_groups = notetype_groups
+            groups = self._notetype_groups.get(mid, [])
+        return [(group, self._folders[group]) for group in groups]
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import shutil
+import sys
+from typing import Any
+
+# Ways of placing exported files in the export folder
+LINK_MODE_COPY = "copy"
+# Copy-on-write clone if supported by the filesystem, otherwise a copy
+LINK_MODE_REFLINK = "reflink"
+# Clone, hard link or copy, whichever works first.
+# Hard-linked files share their contents with the collection's media folder.
+LINK_MODE_LINK = "link"
+LINK_MODES = (LINK_MODE_COPY, LINK_MODE_REFLINK, LINK_MODE_LINK)
+
+# ioctl request to clone a file on Linux (Btrfs, XFS, etc.)
+FICLONE = 0x40049409
+# Number of bytes copied at once by `copy_file()`
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _load_clonefile() -> Any:
+    """Return macOS's clonefile() from libc, or None if it's not available."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        func = libc.clonefile
+    except (OSError, AttributeError, TypeError):
+        return None
+    func.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+
+_clonefile = _load_clonefile() if sys.platform == "darwin" else None
+
+
+def reflink(src_path: str, dest_path: str) -> bool:
+    """Try to make `dest_path` a copy-on-write clone of `src_path` and return whether it worked."""
+    if sys.platform.startswith("linux"):
+        import fcntl
+
+        try:
+            with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+                fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError:
+            try:
+                os.unlink(dest_path)
+            except OSError:
+                pass
+            return False
+    if _clonefile is not None:
+        return _clonefile(os.fsencode(src_path), os.fsencode(dest_path), 0) == 0
+    return False
+
+
+def hardlink(src_path: str, dest_path: str) -> bool:
+    """Try to hard link `dest_path` to `src_path` and return whether it worked."""
+    try:
+        os.link(src_path, dest_path)
+        return True
+    except OSError:
+        return False
+
+
+def copy_file(src_path: str, dest_path: str) -> None:
+    """
+    Copy the contents of `src_path` to `dest_path`.
+    Unlike `shutil.copyfile()`, the files are not stat'd first, which is slow on network drives.
+    """
+    with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+        if sys.platform.startswith("linux"):
+            offset = 0
+            try:
+                while True:
+                    sent = os.sendfile(
+                        dest.fileno(), src.fileno(), offset, COPY_CHUNK_SIZE
+                    )
+                    if not sent:
+                        return
+                    offset += sent
+            except OSError:
+                # Not supported by the filesystem, so copy through Python instead
+                dest.seek(0)
+                dest.truncate()
+        shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+
+
+def place_file(src_path: str, dest_path: str, link_mode: str = LINK_MODE_COPY) -> str:
+    """
+    Create `dest_path` with the contents of `src_path` using one of `LINK_MODES`,
+    replacing any existing file.
+    Returns the method that was used: "reflink", "hardlink" or "copy".
+    """
+    # Never write through an existing hard link, which could modify the source file
+    try:
+        os.unlink(dest_path)
+    except FileNotFoundError:
+        pass
+    if link_mode in (LINK_MODE_REFLINK, LINK_MODE_LINK) and reflink(
+        src_path, dest_path
+    ):
+        return "reflink"
+    if link_mode == LINK_MODE_LINK and hardlink(src_path, dest_path):
+        return "hardlink"
+    copy_file(src_path, dest_path)
+    return "copy"
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
+import asyncio
+import dataclasses
 import functools
+import os
 import time
 from concurrent.futures import Future
-from typing import List, Optional
+from pathlib import Path
+from typing import Callable
 
 import ankiutils.gui.dialog
 import aqt
@@ -15,19 +19,24 @@ from aqt.utils import showWarning, tooltip
 from ..config import config
 from ..consts import consts
 from ..exporter import MediaExporter
+from ..log import logger
+from ..pipeline import export_async
+from ..sinks import ARCHIVE_FORMATS, ExportSink, FolderSink, make_archive_sink
+from ..stats import ExportProgress, ExportStats, format_size
+from ..transcode import TranscodeOptions, Transcoder
 from .multiselect import MultiSelect
 
-ExporterFactory = Callable[[Optional[List[str]], Optional[set]], MediaExporter]
+# Resolution of the progress bar, which is based on bytes that don't fit in its int range
+PROGRESS_STEPS = 1000
 
 
 # pylint: disable=too-many-instance-attributes
 class ExportDialog(ankiutils.gui.dialog.Dialog):
-    def __init__(
-        self, mw: AnkiQt, parent: QWidget, exporter_factory: ExporterFactory
-    ) -> None:
+    def __init__(self, mw: AnkiQt, parent: QWidget, exporter: MediaExporter) -> None:
         self.mw = mw
         self._parent = parent
-        self.exporter_factory = exporter_factory
+        # Unfiltered exporter whose scan is shared by the export
+        self.exporter = exporter
         super().__init__(consts.module, parent)
 
     def export_folder_profile_key(self) -> str:
@@ -42,6 +51,7 @@ class ExportDialog(ankiutils.gui.dialog.Dialog):
     def setup_ui(self) -> None:
         super().setup_ui()
         qconnect(self.finished, self.save_preferences)
+        qconnect(self.finished, self.on_finished)
 
         self.setWindowTitle(consts.name)
         self.setMinimumSize(600, 500)
@@ -60,10 +70,6 @@ class ExportDialog(ankiutils.gui.dialog.Dialog):
         layout.addWidget(QLabel("Included fields"), 1, 0)
         layout.addWidget(self.field_selector, 1, 2, 1, 3)
 
-        exporter = self.exporter_factory(None, None)
-        for field in exporter.all_fields():
-            self.field_selector.add_item(field)
-
         self.ext_selector = MultiSelect(self)
         groupbox = QWidget(self)
         self.custom_exts = QRadioButton("Custom", self)
@@ -82,13 +88,130 @@ class ExportDialog(ankiutils.gui.dialog.Dialog):
         layout.addWidget(groupbox, 2, 1)
         layout.addWidget(self.ext_selector, 2, 2, 1, 3)
 
-        for ext in exporter.all_extensions():
-            self.ext_selector.add_item(ext)
-
-        export_button = QPushButton("Export", self)
-        qconnect(export_button.clicked, self.on_export)
-        layout.addWidget(export_button, 3, 2, 1, 3)
+        self.status_label = QLabel(self)
+        layout.addWidget(self.status_label, 3, 0, 1, 2)
+        self.export_button = QPushButton("Export", self)
+        # Enabled once the fields are known
+        self.export_button.setEnabled(False)
+        qconnect(self.export_button.clicked, self.on_export)
+        layout.addWidget(self.export_button, 3, 2, 1, 3)
         self.restore_preferences()
+        self.start_scan()
+
+    def start_scan(self) -> None:
+        """Find the fields and extensions of the exporter's notes in the background."""
+        self._closed = False
+        self._exporting = False
+        # Set by the export, which shows the progress of the scan while waiting for it
+        self._export_progress: Callable[[ExportProgress], None] | None = None
+        self._export_cancelled = False
+        self.status_label.setText("Scanning notes...")
+
+        def scan_task() -> None:
+            fields = self.exporter.all_fields()
+            self.mw.taskman.run_on_main(functools.partial(self.on_fields_found, fields))
+            note_count = self.exporter.note_count
+            last_update = 0.0
+            for scan in self.exporter.scan_iter():
+                # The export pipeline continues partial scans itself
+                if self._closed and (
+                    not self._exporting
+                    or config["export_pipeline"]
+                    or self._export_cancelled
+                ):
+                    return
+                if scan.complete or time.time() - last_update >= 0.2:
+                    last_update = time.time()
+                    if self._closed:
+                        if self._export_progress is not None:
+                            self._export_progress(
+                                ExportProgress(
+                                    len(scan.note_ids),
+                                    note_count,
+                                    0,
+                                    0,
+                                    0,
+                                    0,
+                                    0,
+                                    totals_known=False,
+                                )
+                            )
+                        continue
+                    scan.update_extension_sizes()
+                    self.mw.taskman.run_on_main(
+                        functools.partial(
+                            self.on_scan_progress,
+                            scanned_count=len(scan.note_ids),
+                            note_count=note_count,
+                            extensions=dict(scan.extensions),
+                            extension_bytes=dict(scan.extension_bytes),
+                            extension_missing=dict(scan.extension_missing),
+                        )
+                    )
+
+        self._scan_future = self.mw.taskman.run_in_background(
+            scan_task, on_done=lambda future: future.result()
+        )
+
+    def on_fields_found(self, fields: list[str]) -> None:
+        if self._closed:
+            return
+        for field in fields:
+            self.field_selector.add_item(
+                field, checked=field.lower() in config["included_fields"]
+            )
+        self.export_button.setEnabled(True)
+
+    def on_scan_progress(
+        self,
+        scanned_count: int,
+        note_count: int,
+        extensions: dict[str, int],
+        extension_bytes: dict[str, int],
+        extension_missing: dict[str, int],
+    ) -> None:
+        if self._closed:
+            return
+        for ext, file_count in extensions.items():
+            size = QLocale().formattedDataSize(extension_bytes.get(ext, 0))
+            description = (
+                f"{file_count} {'file' if file_count == 1 else 'files'}, {size}"
+            )
+            missing_count = extension_missing.get(ext, 0)
+            if missing_count:
+                description += f", {missing_count} missing"
+            row = self.ext_selector.row_for_label(ext)
+            if row == -1:
+                self.ext_selector.add_item(
+                    ext, checked=self.is_extension_checked(ext), description=description
+                )
+            else:
+                self.ext_selector.set_description(row, description)
+        if scanned_count < note_count:
+            self.status_label.setText(f"Scanned {scanned_count} of {note_count} notes")
+        else:
+            self.status_label.setText(f"Scanned {note_count} notes")
+
+    def is_extension_checked(self, ext: str) -> bool:
+        """Whether a newly found extension should be checked according to the chosen media type."""
+        if self.image_exts.isChecked():
+            return ext in aqt.editor.pics
+        if self.sound_exts.isChecked():
+            return ext in aqt.editor.audio
+        return ext.lower() in config["included_extensions"]
+
+    def selected_extensions(self) -> set[str]:
+        exts = set(self.ext_selector.selected_labels())
+        # Include extensions of the chosen media type that were not found yet
+        if self.image_exts.isChecked():
+            exts.update(aqt.editor.pics)
+        elif self.sound_exts.isChecked():
+            exts.update(aqt.editor.audio)
+        return exts
+
+    def on_finished(self) -> None:
+        # Stops the scan unless it's needed for the export
+        self._closed = True
 
     def restore_preferences(self) -> None:
         media_type = config["media_type"]
@@ -97,14 +220,7 @@ class ExportDialog(ankiutils.gui.dialog.Dialog):
         elif media_type == "sounds":
             self.sound_exts.setChecked(True)
         else:
-            for i in range(1, self.ext_selector.count()):
-                checked = (
-                    self.ext_selector.label(i).lower() in config["included_extensions"]
-                )
-                self.ext_selector.set_checked(i, checked)
-        for i in range(1, self.field_selector.count()):
-            checked = self.field_selector.label(i).lower() in config["included_fields"]
-            self.field_selector.set_checked(i, checked)
+            self.custom_exts.setChecked(True)
 
     def save_preferences(self) -> None:
         media_type = "custom"
@@ -113,13 +229,21 @@ class ExportDialog(ankiutils.gui.dialog.Dialog):
         elif self.sound_exts.isChecked():
             media_type = "sounds"
         config["media_type"] = media_type
-        config["included_fields"] = [
-            field.lower() for field in self.field_selector.selected_labels()
-        ]
+        config["included_fields"] = self._merge_preferences(
+            self.field_selector, config["included_fields"]
+        )
         if media_type == "custom":
-            config["included_extensions"] = [
-                field.lower() for field in self.ext_selector.selected_labels()
-            ]
+            config["included_extensions"] = self._merge_preferences(
+                self.ext_selector, config["included_extensions"]
+            )
+
+    @staticmethod
+    def _merge_preferences(selector: MultiSelect, previous: list[str]) -> list[str]:
+        """Return the selected labels, keeping previous choices that are not listed in `selector`,
+        e.g. because the dialog was closed before the scan found them."""
+        labels = {selector.label(i).lower() for i in range(1, selector.count())}
+        selected = [label.lower() for label in selector.selected_labels()]
+        return selected + [label for label in previous if label not in labels]
 
     def on_folder_button(self) -> None:
         default_folder = self.default_export_folder()
@@ -150,55 +274,119 @@ class ExportDialog(ankiutils.gui.dialog.Dialog):
                 checked = True
             self.ext_selector.set_checked(i, checked)
 
+    @staticmethod
+    def make_sink(folder: str, name: str) -> ExportSink:
+        """Return the sink to export to according to the config."""
+        archive_format = config["archive_format"]
+        if archive_format in ARCHIVE_FORMATS:
+            return make_archive_sink(
+                os.path.join(folder, name + ARCHIVE_FORMATS[archive_format]),
+                archive_format,
+            )
+        return FolderSink(
+            folder,
+            incremental=config["incremental_export"],
+            hashes=config["manifest_hashes"],
+            link_mode=config["link_mode"],
+            dedupe=config["dedupe_files"],
+        )
+
+    @staticmethod
+    def make_transcoder() -> Transcoder | None:
+        """Return a transcoder for the conversions enabled in the config, if any."""
+        if not config["transcode_images"] and not config["transcode_audio"]:
+            return None
+        options = TranscodeOptions(
+            images=config["transcode_images"],
+            image_max_size=config["image_max_size"],
+            image_quality=config["image_quality"],
+            audio=config["transcode_audio"],
+            audio_format=config["audio_format"],
+            audio_bitrate=config["audio_bitrate"],
+        )
+        return Transcoder(options, Path(consts.dir) / "user_files" / "transcode_cache")
+
     def on_export(self) -> None:
         fields = self.field_selector.selected_labels()
-        exts = self.ext_selector.selected_labels()
+        exts = self.selected_extensions()
         folder = self.folder_lineedit.text()
-        exporter = self.exporter_factory(fields, set(exts))
-        note_count = len(exporter.notes)
+        exporter = self.exporter.with_filters(fields, exts)
 
         if not folder:
             showWarning("No folder set", self, title=consts.name)
             return
 
+        self._exporting = True
         self.accept()
 
-        want_cancel = False
-
-        def export_task() -> int:
-            last_progress = 0.0
-            media_i = 0
-            for notes_i, (media_i, _) in enumerate(exporter.export(folder)):
-                if time.time() - last_progress >= 0.1:
-                    last_progress = time.time()
-                    self.mw.taskman.run_on_main(
-                        functools.partial(
-                            update_progress,
-                            notes_i=notes_i,
-                            note_count=note_count,
-                            media_i=media_i,
+        def export_task() -> ExportStats:
+            # Wait for the scan started by the dialog to finish or stop, which it does if the export is cancelled
+            self._scan_future.result()
+            if self._export_cancelled:
+                return ExportStats()
+            transcoder = self.make_transcoder()
+            if config["export_pipeline"]:
+                try:
+                    return asyncio.run(
+                        export_async(
+                            exporter,
+                            self.make_sink(folder, exporter.name),
+                            writers=config["copy_workers"],
+                            queue_size=config["pipeline_queue_size"],
+                            progress=on_progress,
+                            transcoder=transcoder,
+                            cancelled=lambda: self._export_cancelled,
                         )
                     )
-                    if want_cancel:
+                finally:
+                    if transcoder is not None:
+                        transcoder.close()
+            export_iter = exporter.export(
+                self.make_sink(folder, exporter.name),
+                workers=config["copy_workers"],
+                progress=on_progress,
+                transcoder=transcoder,
+            )
+            try:
+                for _ in export_iter:
+                    if self._export_cancelled:
                         break
-            return media_i
+            finally:
+                # Stop copies that are still queued
+                export_iter.close()
+                if transcoder is not None:
+                    transcoder.close()
+            # Set once the export starts
+            assert exporter.stats is not None
+            return exporter.stats
+
+        def on_progress(progress: ExportProgress) -> None:
+            # The exporter keeps updating the object, so a copy is passed to the main thread
+            self.mw.taskman.run_on_main(
+                functools.partial(update_progress, dataclasses.replace(progress))
+            )
 
-        def update_progress(notes_i: int, note_count: int, media_i: int) -> None:
-            nonlocal want_cancel
+        def update_progress(progress: ExportProgress) -> None:
             self.mw.progress.update(
-                label=f"Processed {notes_i+1} notes and exported {media_i} files",
-                max=note_count,
-                value=notes_i + 1,
+                label=progress.describe(),
+                max=PROGRESS_STEPS,
+                value=round(progress.fraction * PROGRESS_STEPS),
             )
-            want_cancel = self.mw.progress.want_cancel()
+            self._export_cancelled = self.mw.progress.want_cancel()
 
         def on_done(future: Future) -> None:
             try:
-                count = future.result()
+                stats = future.result()
             finally:
                 self.mw.progress.finish()
-            tooltip(f"Exported {count} media files", parent=self._parent)
+            logger.info("Exported media from %s: %s", exporter.name, stats.summary())
+            tooltip(
+                f"Exported {stats.counters['exported']} media files "
+                f"({format_size(stats.throughput)}/s)",
+                parent=self._parent,
+            )
 
+        self._export_progress = on_progress
         self.mw.progress.start(label="Exporting media...", parent=self._parent)
         self.mw.progress.set_title(consts.name)
         self.mw.taskman.run_in_background(export_task, on_done=on_done)
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+from concurrent.futures import Future
+from typing import Callable
+
+from anki.collection import OpChanges
+from anki.decks import DeckId
+from anki.notes import Note, NoteId
+from aqt.main import AnkiQt
+from aqt.qt import *
+
+from ..config import config
+from ..log import logger
+from ..media_index import MediaReferenceIndex
+from ..mirror import MediaMirror, MirrorChanges
+
+
+class MirrorWatcher:
+    """
+    Keeps the folders in the `mirrors` config option in sync with the media of their decks.
+    Each mirror is synced fully when the profile opens; note changes are then batched
+    and applied once no change was made for `mirror_delay` seconds.
+    """
+
+    def __init__(self, mw: AnkiQt) -> None:
+        self.mw = mw
+        self.mirrors: list[MediaMirror] = []
+        self._timer = QTimer(mw)
+        self._timer.setSingleShot(True)
+        qconnect(self._timer.timeout, self._on_timer)
+        # Notes edited since the last refresh, which might not be saved yet
+        self._edited: dict[NoteId, Note] = {}
+        self._future: Future | None = None
+
+    def start(self, index: MediaReferenceIndex | None = None) -> None:
+        """Set up the mirrors of the current profile and sync them in the background."""
+        self.stop()
+        for entry in config["mirrors"]:
+            did = self.mw.col.decks.id_for_name(entry["deck"])
+            if did is None:
+                logger.warning("Deck to mirror not found: %s", entry["deck"])
+                continue
+            exts = entry.get("extensions")
+            self.mirrors.append(
+                MediaMirror(
+                    self.mw.col,
+                    DeckId(did),
+                    entry["folder"],
+                    entry.get("fields"),
+                    set(exts) if exts is not None else None,
+                    index,
+                )
+            )
+        if self.mirrors:
+            self._run(lambda mirror: mirror.sync())
+
+    def stop(self) -> None:
+        self._timer.stop()
+        if self._future is not None:
+            # Don't let the background task outlive the collection; errors are reported by it
+            self._future.exception()
+            self._future = None
+        self.mirrors = []
+        self._edited.clear()
+
+    def schedule(self, note: Note | None = None) -> None:
+        """Refresh the mirrors once no change was made for `mirror_delay` seconds."""
+        if not self.mirrors:
+            return
+        if note is not None and note.id:
+            self._edited[note.id] = note
+        self._timer.start(int(config["mirror_delay"] * 1000))
+
+    def on_operation_did_execute(self, changes: OpChanges, handler: object) -> None:
+        # Changes to cards and decks matter when cards move between decks, which the reviewer doesn't do,
+        # so answering cards doesn't cause a refresh
+        if (
+            changes.note_text
+            or changes.notetype
+            or ((changes.card or changes.deck) and handler is not self.mw.reviewer)
+        ):
+            self.schedule()
+
+    def on_sync_did_finish(self) -> None:
+        # Synced notes can have modification times older than the last refresh, which refresh() handles
+        self.schedule()
+
+    def _on_timer(self) -> None:
+        if self._future is not None:
+            # Try again once the running refresh is done
+            self._timer.start(int(config["mirror_delay"] * 1000))
+            return
+        edited = list(self._edited.values())
+        self._edited.clear()
+        self._run(lambda mirror: mirror.refresh(edited))
+
+    def _run(self, changes_for: Callable[[MediaMirror], MirrorChanges]) -> None:
+        mirrors = list(self.mirrors)
+
+        def task() -> None:
+            for mirror in mirrors:
+                changes = changes_for(mirror)
+                if changes:
+                    stats = mirror.apply(changes)
+                    logger.info(
+                        "Mirrored media to %s: %s", mirror.folder, stats.summary()
+                    )
+
+        def on_done(future: Future) -> None:
+            if self._future is future:
+                self._future = None
+            future.result()
+
+        self._future = self.mw.taskman.run_in_background(task, on_done=on_done)
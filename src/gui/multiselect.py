@@ -26,13 +26,31 @@ class MultiSelect(QListWidget):
         qconnect(widget.stateChanged, self._on_check_all)
         self.setItemWidget(item, widget)
 
-    def add_item(self, label: str) -> None:
+    def add_item(self, label: str, checked: bool = True, description: str = "") -> None:
         item = QListWidgetItem(self)
+        item.setData(Qt.ItemDataRole.UserRole, label)
         self.addItem(item)
-        widget = QCheckBox(label, self)
+        widget = QCheckBox(self._item_text(label, description), self)
         qconnect(widget.stateChanged, self._on_item_state_changed)
         self.setItemWidget(item, widget)
-        widget.setChecked(True)
+        widget.setChecked(checked)
+        self._on_item_state_changed(0)
+
+    @staticmethod
+    def _item_text(label: str, description: str) -> str:
+        return f"{label} ({description})" if description else label
+
+    def row_for_label(self, label: str) -> int:
+        """Return the row of the item with the given label, or -1 if not found."""
+        for i in range(1, self.count()):
+            if self.label(i) == label:
+                return i
+        return -1
+
+    def set_description(self, row: int, description: str) -> None:
+        item = self.item(row)
+        widget = cast(QCheckBox, self.itemWidget(item))
+        widget.setText(self._item_text(self.label(row), description))
 
     def _on_item_state_changed(self, state: int) -> None:
         checked_count = 0
@@ -70,9 +88,7 @@ class MultiSelect(QListWidget):
         widget.setChecked(checked)
 
     def label(self, row: int) -> str:
-        item = self.item(row)
-        widget = cast(QCheckBox, self.itemWidget(item))
-        return widget.text()
+        return self.item(row).data(Qt.ItemDataRole.UserRole)
 
     def selected_labels(self) -> list[str]:
         labels = []
@@ -80,5 +96,5 @@ class MultiSelect(QListWidget):
             item = self.item(i)
             widget = cast(QCheckBox, self.itemWidget(item))
             if widget.isChecked():
-                labels.append(widget.text())
+                labels.append(self.label(i))
         return labels
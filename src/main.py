@@ -2,7 +2,9 @@ from __future__ import annotations
 
 import os
 import sys
+from pathlib import Path
 
+from anki import hooks
 from anki.decks import DeckId
 from aqt import gui_hooks, mw
 from aqt.editor import Editor
@@ -19,34 +21,73 @@ sys.path.append(os.path.join(os.path.dirname(__file__), "vendor"))
 from .config import config
 from .consts import consts
 from .errors import setup_error_handler
-from .exporter import DeckMediaExporter, NoteMediaExporter
+from .exporter import (
+    DeckMediaExporter,
+    MultiDeckMediaExporter,
+    NoteMediaExporter,
+    SearchMediaExporter,
+)
 from .gui.export_dialog import ExportDialog
+from .gui.mirror import MirrorWatcher
+from .media_index import MediaReferenceIndex
+
+_media_index: MediaReferenceIndex | None = None
+mirror_watcher = MirrorWatcher(mw)
+
+
+def get_media_index() -> MediaReferenceIndex:
+    """Return the media reference index of the current profile."""
+    global _media_index
+
+    if _media_index is None:
+        _media_index = MediaReferenceIndex(
+            Path(consts.dir) / "user_files" / "media_index" / f"{mw.pm.name}.db"
+        )
+    return _media_index
+
+
+def on_profile_did_open() -> None:
+    mirror_watcher.start(get_media_index())
+
+
+def on_profile_will_close() -> None:
+    global _media_index
+
+    mirror_watcher.stop()
+    if _media_index is not None:
+        _media_index.close()
+        _media_index = None
 
 
 def on_deck_browser_will_show_options_menu(menu: QMenu, did: int) -> None:
     def export_media() -> None:
-        def exporter_factory(
-            fields: list[str] | None = None, exts: set | None = None
-        ) -> DeckMediaExporter:
-            return DeckMediaExporter(
-                mw.col, DeckId(did), fields, exts, config["organize_into_subfolders"]
-            )
-
-        dialog = ExportDialog(mw, mw, exporter_factory)
+        exporter = DeckMediaExporter(
+            mw.col,
+            DeckId(did),
+            organize_into_subfolders=config["organize_into_subfolders"],
+            index=get_media_index(),
+        )
+        dialog = ExportDialog(mw, mw, exporter)
+        dialog.exec()
+
+    def export_subdecks_media() -> None:
+        exporter = MultiDeckMediaExporter.from_tree(
+            mw.col, DeckId(did), index=get_media_index()
+        )
+        dialog = ExportDialog(mw, mw, exporter)
         dialog.exec()
 
     action = menu.addAction("Export Media")
     qconnect(action.triggered, export_media)
+    if mw.col.decks.children(DeckId(did)):
+        action = menu.addAction("Export Media of Each Subdeck")
+        qconnect(action.triggered, export_subdecks_media)
 
 
 def add_editor_button(buttons: list[str], editor: Editor) -> None:
     def on_clicked(editor: Editor) -> None:
-        def exporter_factory(
-            fields: list[str] | None = None, exts: set | None = None
-        ) -> NoteMediaExporter:
-            return NoteMediaExporter(mw.col, [editor.note], fields, exts)
-
-        dialog = ExportDialog(mw, editor.parentWindow, exporter_factory)
+        exporter = NoteMediaExporter(mw.col, [editor.note])
+        dialog = ExportDialog(mw, editor.parentWindow, exporter)
         dialog.exec()
 
     button = editor.addButton(
@@ -60,14 +101,10 @@ def add_editor_button(buttons: list[str], editor: Editor) -> None:
 
 def add_browser_menu_item(browser: Browser) -> None:
     def export_selected() -> None:
-        selected_notes = [mw.col.get_note(nid) for nid in browser.selected_notes()]
-
-        def exporter_factory(
-            fields: list[str] | None = None, exts: set | None = None
-        ) -> NoteMediaExporter:
-            return NoteMediaExporter(mw.col, selected_notes, fields, exts)
-
-        dialog = ExportDialog(mw, browser, exporter_factory)
+        exporter = SearchMediaExporter(
+            mw.col, browser.selected_notes(), index=get_media_index()
+        )
+        dialog = ExportDialog(mw, browser, exporter)
         dialog.exec()
 
     action = QAction("Export Media", browser)
@@ -80,4 +117,10 @@ gui_hooks.deck_browser_will_show_options_menu.append(
 )
 gui_hooks.editor_did_init_buttons.append(add_editor_button)
 gui_hooks.browser_menus_did_init.append(add_browser_menu_item)
+gui_hooks.profile_did_open.append(on_profile_did_open)
+gui_hooks.profile_will_close.append(on_profile_will_close)
+hooks.note_will_be_added.append(lambda col, note, deck_id: mirror_watcher.schedule())
+gui_hooks.editor_did_fire_typing_timer.append(mirror_watcher.schedule)
+gui_hooks.operation_did_execute.append(mirror_watcher.on_operation_did_execute)
+gui_hooks.sync_did_finish.append(mirror_watcher.on_sync_did_finish)
 setup_error_handler()
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import IO
+
+MANIFEST_FILENAME = ".media_exporter_manifest.jsonl"
+
+
+def file_sha1(path: str) -> str:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+@dataclass
+class ManifestEntry:
+    """State of a source media file at the time it was exported."""
+
+    size: int
+    mtime_ns: int
+    sha1: str | None = None
+
+
+def check_media_file(
+    src_path: str,
+    dest_path: str,
+    previous: ManifestEntry | None = None,
+    hashes: bool = False,
+    stat: os.stat_result | None = None,
+) -> tuple[ManifestEntry, bool] | None:
+    """
+    Return the new manifest entry of `src_path` and whether `dest_path` is still up to date
+    according to `previous`, the file's entry from the last export.
+    `stat` is the result of stat-ing `src_path` if it was already done.
+    Returns None if `src_path` doesn't exist.
+    """
+    if stat is None:
+        try:
+            stat = os.stat(src_path)
+        except FileNotFoundError:
+            return None
+    entry = ManifestEntry(stat.st_size, stat.st_mtime_ns)
+    up_to_date = False
+    if previous is not None and previous.size == entry.size:
+        try:
+            dest_size = os.stat(dest_path).st_size
+        except FileNotFoundError:
+            dest_size = -1
+        if dest_size == entry.size:
+            if previous.mtime_ns == entry.mtime_ns:
+                entry.sha1 = previous.sha1
+                up_to_date = True
+            elif hashes and previous.sha1:
+                # The file was touched, but its contents might be the same
+                entry.sha1 = file_sha1(src_path)
+                up_to_date = entry.sha1 == previous.sha1
+    if hashes and entry.sha1 is None:
+        entry.sha1 = file_sha1(src_path)
+    return entry, up_to_date
+
+
+class ExportManifest:
+    """
+    Record of the files exported to a folder, used to skip unchanged files in later exports.
+
+    Entries are appended to a journal as files are exported, so a cancelled or interrupted export
+    can be resumed. The journal is compacted when the manifest is closed.
+    """
+
+    def __init__(self, folder: Path | str) -> None:
+        self.path = Path(folder) / MANIFEST_FILENAME
+        self._entries: dict[str, ManifestEntry] = {}
+        self._journal: IO[str] | None = None
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        data = json.loads(line)
+                        name = data.pop("name")
+                        if data.get("removed"):
+                            self._entries.pop(name, None)
+                        else:
+                            self._entries[name] = ManifestEntry(**data)
+                    except (ValueError, KeyError, TypeError):
+                        # Most likely a partially written line from an interrupted export
+                        continue
+        except FileNotFoundError:
+            pass
+
+    def get(self, name: str) -> ManifestEntry | None:
+        return self._entries.get(name)
+
+    def names(self) -> list[str]:
+        return list(self._entries)
+
+    def _append(self, data: dict) -> None:
+        if self._journal is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._journal = open(self.path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(data) + "\n")
+
+    def record(self, name: str, entry: ManifestEntry) -> None:
+        if self._entries.get(name) == entry:
+            return
+        self._entries[name] = entry
+        self._append({"name": name, **asdict(entry)})
+
+    def forget(self, name: str) -> None:
+        """Remove the entry of `name`, e.g. after deleting the exported file."""
+        if self._entries.pop(name, None) is not None:
+            self._append({"name": name, "removed": True})
+
+    def flush(self) -> None:
+        if self._journal is not None:
+            self._journal.flush()
+
+    def close(self) -> None:
+        """Close the journal and rewrite it without superseded entries."""
+        if self._journal is None:
+            return
+        self._journal.close()
+        self._journal = None
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            for name, entry in self._entries.items():
+                file.write(json.dumps({"name": name, **asdict(entry)}) + "\n")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import os
+import unicodedata
+
+
+def normalize_filename(filename: str) -> str:
+    """Normalize `filename` to NFC, the form Anki uses for media filenames in notes."""
+    if filename.isascii():
+        return filename
+    return unicodedata.normalize("NFC", filename)
+
+
+class MediaDirIndex:
+    """
+    Listing of the files in a media folder, read with a single `os.scandir()` pass,
+    so existence checks don't need a syscall per referenced file.
+    Files are stat'd at most once, when first needed; the result is passed on to sinks
+    so they don't stat the file again.
+
+    Filenames are looked up in NFC, so files whose names are stored decomposed on disk
+    (e.g. by older macOS filesystems) are still found.
+    """
+
+    def __init__(self, media_dir: str) -> None:
+        self.media_dir = media_dir
+        self._entries: dict[str, os.DirEntry] | None = None
+        # Results of lookups of names not in the listing
+        self._fallbacks: dict[str, os.stat_result | None] = {}
+        # Results of stat-ing files in the listing
+        self._stats: dict[str, os.stat_result | None] = {}
+
+    @property
+    def entries(self) -> dict[str, os.DirEntry]:
+        """Map of normalized filenames to directory entries, read on first access."""
+        if self._entries is None:
+            entries = {}
+            try:
+                with os.scandir(self.media_dir) as iterator:
+                    for entry in iterator:
+                        entries[normalize_filename(entry.name)] = entry
+            except FileNotFoundError:
+                pass
+            self._entries = entries
+        return self._entries
+
+    def _fallback_stat(self, filename: str) -> os.stat_result | None:
+        # The listing is case-sensitive, but the filesystem might not be,
+        # in which case Anki still finds the file
+        if filename not in self._fallbacks:
+            try:
+                stat = os.stat(os.path.join(self.media_dir, filename))
+            except (OSError, ValueError):
+                stat = None
+            self._fallbacks[filename] = stat
+        return self._fallbacks[filename]
+
+    def path(self, filename: str) -> str | None:
+        """Return the path of `filename` in the media folder, or None if it doesn't exist."""
+        entry = self.entries.get(normalize_filename(filename))
+        if entry is not None:
+            return entry.path
+        if self._fallback_stat(filename) is not None:
+            return os.path.join(self.media_dir, filename)
+        return None
+
+    def stat(self, filename: str) -> os.stat_result | None:
+        """Return the result of stat-ing `filename`, or None if it doesn't exist."""
+        key = normalize_filename(filename)
+        entry = self.entries.get(key)
+        if entry is None:
+            return self._fallback_stat(filename)
+        if key not in self._stats:
+            try:
+                # Free on Windows, where the listing already includes it
+                stat: os.stat_result | None = entry.stat()
+            except OSError:
+                stat = None
+            self._stats[key] = stat
+        return self._stats[key]
+
+    def size(self, filename: str) -> int | None:
+        stat = self.stat(filename)
+        return stat.st_size if stat is not None else None
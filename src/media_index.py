@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Sequence
+
+from anki.models import NotetypeDict, NotetypeId
+from anki.notes import NoteId
+from anki.utils import ids2str
+
+SCHEMA_VERSION = 2
+
+
+class MediaReferenceIndex:
+    """
+    On-disk index of the media files referenced by each field of a note.
+
+    Entries are invalidated when the note's `mod` or `usn` columns change,
+    so only modified notes need to be parsed again in later scans.
+    As `mod` is in seconds, notes modified in the current second are not stored,
+    since another edit in the same second would leave it unchanged.
+    Entries of a notetype's notes are also dropped when its LaTeX settings change,
+    as the names of LaTeX images depend on them.
+    """
+
+    def __init__(self, path: Path | str) -> None:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # The index is used from both the main thread and background tasks
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        version = self._db.execute("pragma user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self._db.execute("drop table if exists refs")
+            self._db.execute("drop table if exists notetypes")
+            self._db.execute(f"pragma user_version = {SCHEMA_VERSION}")
+        self._db.execute(
+            """create table if not exists refs (
+                nid integer primary key,
+                mid integer not null,
+                mod integer not null,
+                usn integer not null,
+                files text not null
+            )"""
+        )
+        self._db.execute(
+            """create table if not exists notetypes (
+                mid integer primary key,
+                latex text not null
+            )"""
+        )
+        self._db.commit()
+
+    def check_notetype(self, notetype: NotetypeDict) -> None:
+        """Drop the entries of the notes of `notetype` if its LaTeX settings changed since they were stored."""
+        latex = json.dumps(
+            [
+                notetype.get("latexPre", ""),
+                notetype.get("latexPost", ""),
+                bool(notetype.get("latexsvg", False)),
+            ]
+        )
+        with self._lock:
+            row = self._db.execute(
+                "select latex from notetypes where mid = ?", (notetype["id"],)
+            ).fetchone()
+            if row is not None and row[0] == latex:
+                return
+            self._db.execute("delete from refs where mid = ?", (notetype["id"],))
+            self._db.execute(
+                "insert or replace into notetypes (mid, latex) values (?, ?)",
+                (notetype["id"], latex),
+            )
+            self._db.commit()
+
+    def get_many(
+        self, notes: Sequence[tuple[NoteId, NotetypeId, int, int]]
+    ) -> dict[NoteId, list[list[str]]]:
+        """
+        Return the media files of each field of the given (id, mid, mod, usn) notes.
+        Notes that are not indexed or were modified since they were indexed are omitted.
+        """
+        if not notes:
+            return {}
+        with self._lock:
+            rows = self._db.execute(
+                "select nid, mid, mod, usn, files from refs where nid in %s"
+                % ids2str(note[0] for note in notes)
+            ).fetchall()
+        indexed = {row[0]: row for row in rows}
+        field_media = {}
+        for nid, mid, mod, usn in notes:
+            row = indexed.get(nid)
+            if row is not None and row[1:4] == (mid, mod, usn):
+                field_media[nid] = json.loads(row[4])
+        return field_media
+
+    def put_many(
+        self,
+        entries: Iterable[tuple[NoteId, NotetypeId, int, int, list[list[str]]]],
+    ) -> None:
+        """
+        Store the media files of each field of the given (id, mid, mod, usn, field media) notes,
+        except notes modified in the current second or later.
+        """
+        now = int(time.time())
+        with self._lock:
+            self._db.executemany(
+                "insert or replace into refs (nid, mid, mod, usn, files) values (?, ?, ?, ?, ?)",
+                (
+                    (nid, mid, mod, usn, json.dumps(files, separators=(",", ":")))
+                    for nid, mid, mod, usn, files in entries
+                    if mod < now
+                ),
+            )
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
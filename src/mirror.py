@@ -0,0 +1,196 @@
+"""Keeping a folder in sync with the media of a deck as its notes change."""
+
+from __future__ import annotations
+
+import os
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from anki.collection import Collection
+from anki.decks import DeckId
+from anki.models import NotetypeId
+from anki.notes import Note, NoteId
+from anki.utils import ids2str
+
+from .exporter import DeckMediaExporter, get_note_media, get_notetype_media
+from .manifest import ExportManifest
+from .media_dir import MediaDirIndex
+from .media_index import MediaReferenceIndex
+from .sinks import FolderSink
+from .stats import ExportStats
+
+
+class MirrorChanges(NamedTuple):
+    """Files to write to and remove from a mirror folder."""
+
+    write: list[str]
+    remove: list[str]
+
+    def __bool__(self) -> bool:
+        return bool(self.write or self.remove)
+
+
+# pylint: disable=too-many-instance-attributes
+class MediaMirror:
+    """
+    Keeps `folder` in sync with the media of the notes in deck `did` and its subdecks.
+    `sync()` works out the changes needed to mirror the whole deck, and `refresh()` those caused by notes
+    that changed since the last call. Both access the collection; `apply()` writes the changes to the folder.
+    Only files written by the mirror are removed from the folder.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        col: Collection,
+        did: DeckId,
+        folder: Path | str,
+        fields: list[str] | None = None,
+        exts: set | None = None,
+        index: MediaReferenceIndex | None = None,
+    ) -> None:
+        self.col = col
+        self.did = did
+        self.folder = Path(folder)
+        self.fields = fields
+        self.exts = exts
+        self.index = index
+        self._media_dir = col.media.dir()
+        self._note_media: dict[NoteId, list[str]] = {}
+        self._notetype_media: dict[NotetypeId, list[str]] = {}
+        # Notetype ID and modification time of each mirrored note, to find notes modified since
+        self._notes: dict[NoteId, tuple[NotetypeId, int]] = {}
+        # Number of notes and notetypes referencing each mirrored file
+        self._refcounts: Counter[str] = Counter()
+        # Stats of the last call to `apply()`
+        self.stats: ExportStats | None = None
+
+    def _included(self, media: Iterable[str]) -> list[str]:
+        return list(
+            dict.fromkeys(
+                filename
+                for filename in media
+                if self.exts is None or os.path.splitext(filename)[1][1:] in self.exts
+            )
+        )
+
+    def _set_media(self, media_dict: dict, key: int, media: list[str]) -> set[str]:
+        """Replace the media referenced by `key` in `media_dict`, returning the files whose references changed."""
+        previous = media_dict.pop(key, [])
+        if media:
+            media_dict[key] = media
+        if previous == media:
+            return set()
+        self._refcounts.subtract(previous)
+        self._refcounts.update(media)
+        return set(previous).symmetric_difference(media)
+
+    def _changes(
+        self, touched: set[str], present: set[str], rewrite: bool = False
+    ) -> MirrorChanges:
+        """
+        Return the changes to `touched` files, of which `present` were mirrored before.
+        If `rewrite` is True, files that are still used are written again even if they were mirrored before.
+        """
+        refcounts = self._refcounts
+        write = sorted(
+            name
+            for name in touched
+            if refcounts[name] > 0 and (rewrite or name not in present)
+        )
+        remove = sorted(
+            name for name in touched if refcounts[name] <= 0 and name in present
+        )
+        for name in touched:
+            if refcounts[name] <= 0:
+                del refcounts[name]
+        return MirrorChanges(write, remove)
+
+    def _update_notetypes(self) -> set[str]:
+        touched = set()
+        mids = {mid for mid, _ in self._notes.values()}
+        for mid in list(self._notetype_media):
+            if mid not in mids:
+                touched |= self._set_media(self._notetype_media, mid, [])
+        for mid in mids:
+            media = self._included(get_notetype_media(self.col.models.get(mid)))
+            touched |= self._set_media(self._notetype_media, mid, media)
+        return touched
+
+    def _deck_notes(self) -> dict[NoteId, tuple[NotetypeId, int]]:
+        """Return the notetype ID and modification time of each note in the deck."""
+        # Cards in filtered decks still belong to their original deck
+        dids = ids2str(self.col.decks.deck_and_child_ids(self.did))
+        return {
+            NoteId(nid): (NotetypeId(mid), mod)
+            for nid, mid, mod in self.col.db.execute(
+                "select distinct n.id, n.mid, n.mod from notes n join cards c on c.nid = n.id "
+                f"where c.did in {dids} or c.odid in {dids}"
+            )
+        }
+
+    def sync(self) -> MirrorChanges:
+        """
+        Scan the whole deck and return the changes needed to mirror it,
+        including removing files exported by earlier runs that are no longer used.
+        """
+        exporter = DeckMediaExporter(
+            self.col, self.did, self.fields, self.exts, index=self.index
+        )
+        self._note_media.clear()
+        self._notetype_media.clear()
+        self._refcounts.clear()
+        self._notes = self._deck_notes()
+        # pylint: disable=protected-access
+        for nid, media in exporter._note_media_lists():
+            if nid is not None:
+                self._set_media(self._note_media, nid, self._included(media))
+        self._update_notetypes()
+        present = set(ExportManifest(self.folder).names())
+        return self._changes(set(self._refcounts) | present, present, rewrite=True)
+
+    def refresh(self, notes: Iterable[Note] = ()) -> MirrorChanges:
+        """
+        Return the changes caused by notes added to, removed from or modified in the deck since the last call.
+        Notes are compared by modification time rather than checked for a newer one, as syncing can
+        bring in notes modified before the last call. `notes` are notes whose fields might have changed without being saved yet, e.g. in the editor.
+        """
+        edited = {note.id: note for note in notes if note.id}
+        deck_notes = self._deck_notes()
+        present = {name for name, count in self._refcounts.items() if count > 0}
+        touched = set()
+        for nid in list(self._note_media):
+            if nid not in deck_notes:
+                touched |= self._set_media(self._note_media, nid, [])
+        for nid, mid_mod in deck_notes.items():
+            if self._notes.get(nid) == mid_mod and nid not in edited:
+                continue
+            note = edited.get(nid) or self.col.get_note(nid)
+            media = self._included(get_note_media(self.col, note, self.fields))
+            touched |= self._set_media(self._note_media, nid, media)
+        self._notes = deck_notes
+        touched |= self._update_notetypes()
+        return self._changes(touched, present)
+
+    def apply(self, changes: MirrorChanges) -> ExportStats:
+        """Write and remove the files in `changes`. Doesn't access the collection."""
+        stats = ExportStats()
+        start = time.perf_counter()
+        # Listed anew each time, as files are added to the media folder
+        files = MediaDirIndex(self._media_dir)
+        with FolderSink(self.folder) as sink:
+            sink.stats = stats
+            with stats.timed("write"):
+                for filename in changes.write:
+                    src_path = files.path(filename)
+                    written = src_path is not None and sink.write(
+                        src_path, filename, files.stat(filename)
+                    )
+                    stats.count(exported=int(written), missing=int(not written))
+                for filename in changes.remove:
+                    sink.remove(filename)
+        stats.phases["export"] = time.perf_counter() - start
+        self.stats = stats
+        return stats
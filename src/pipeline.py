@@ -0,0 +1,290 @@
+"""
+Asyncio export pipeline that overlaps scanning notes with writing files.
+
+Stages are connected by bounded queues, so a slow stage holds back the ones before it:
+1. Notes are read and their media extracted in batches on a single thread that does all collection access.
+2. Files to export are resolved on the event loop: duplicates, extension filters and missing files are skipped.
+3. Several writer tasks write files concurrently using `asyncio.to_thread()`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import itertools
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, NamedTuple, Optional, Sequence
+
+from anki.models import NotetypeId
+from anki.notes import NoteId
+
+from .exporter import (
+    DEFAULT_COPY_WORKERS,
+    ExportWriter,
+    FirstWrites,
+    MediaExporter,
+    ProgressReporter,
+    worker_count,
+)
+from .plan import ExportPlan
+from .sinks import ExportSink
+from .stats import ExportProgress, ExportStats
+from .transcode import Transcoder
+
+# Maximum number of note batches and files waiting in the queues between stages
+DEFAULT_QUEUE_SIZE = 256
+# Number of notes scanned per call to the collection thread
+NOTES_BATCH_SIZE = 100
+
+
+class NoteRefs(NamedTuple):
+    """Media of a note (or of a notetype if `nid` is None) and the folders it's exported to."""
+
+    nid: NoteId | None
+    refs: array
+    folders: Sequence[tuple[int, Path]]
+
+
+class FileToWrite(NamedTuple):
+    folder: Path
+    filename: str
+    src_path: str
+    # Pending result of the first copy of the file if this copy should be linked to it
+    link_to: Optional[asyncio.Future]
+    # Set with the result of this write if other copies are linked to it
+    written: Optional[asyncio.Future]
+
+
+class _Scanner:
+    """
+    Scans the notes of an exporter in batches, continuing a partial scan if there is one.
+    Must be created and used on the collection thread.
+    """
+
+    def __init__(self, exporter: MediaExporter) -> None:
+        self.exporter = exporter
+        self._steps = exporter.scan_notes(resume=True)
+        self._mids: set[NotetypeId] = set()
+
+    def _batch(self, start: int) -> list[NoteRefs]:
+        """Return the media of the notes scanned so far from the note at index `start` in the scan."""
+        exporter = self.exporter
+        batch = []
+        for nid, mid, refs in exporter.note_media_refs(start):
+            self._mids.add(mid)
+            batch.append(NoteRefs(nid, refs, exporter.note_folders(nid, mid)))
+        return batch
+
+    def start(self) -> list[NoteRefs]:
+        """
+        Return the media of notes already in a partial scan, which are not scanned again,
+        e.g. if the export dialog's scan was interrupted.
+        """
+        return self._batch(0)
+
+    def next_batch(self) -> list[NoteRefs] | None:
+        """Scan the next batch of notes, returning None once all notes were scanned."""
+        start = len(self.exporter.partial_scan.note_ids)
+        if not any(True for _ in itertools.islice(self._steps, NOTES_BATCH_SIZE)):
+            return None
+        return self._batch(start)
+
+    def finish(self) -> list[NoteRefs]:
+        """Return the media of the notetypes of the exported notes, once the scan is complete."""
+        exporter = self.exporter
+        scan = exporter.partial_scan
+        return [
+            NoteRefs(None, scan.notetype_media[mid], exporter.note_folders(None, mid))
+            for mid in self._mids
+        ]
+
+
+# pylint: disable=too-many-arguments,too-many-locals,too-many-statements
+async def export_async(
+    exporter: MediaExporter,
+    sink: ExportSink,
+    writers: int = DEFAULT_COPY_WORKERS,
+    queue_size: int = DEFAULT_QUEUE_SIZE,
+    progress: Callable[[ExportProgress], None] | None = None,
+    transcoder: Transcoder | None = None,
+    cancelled: Callable[[], bool] | None = None,
+) -> ExportStats:
+    """
+    Export the media of `exporter` to `sink` like `MediaExporter.export()`, scanning notes while writing files.
+    If the exporter's scan is already complete, files are taken from its plan instead.
+    `writers` files are written at once if the sink supports it. `progress` is called from the event loop's thread.
+    `cancelled` is polled regularly to stop the export early.
+    The sink is closed when the export finishes. Returns the stats of the scan and export, also stored in `exporter.stats`.
+    """
+    loop = asyncio.get_running_loop()
+    # All collection access happens on this thread
+    col_executor = ThreadPoolExecutor(max_workers=1)
+
+    def on_collection_thread(func: Callable, *args: Any) -> asyncio.Future:
+        return loop.run_in_executor(col_executor, func, *args)
+
+    scan = exporter.partial_scan
+    streaming = not scan.complete
+    stats = ExportStats()
+    sink.stats = stats
+    writers = worker_count(writers, sink, transcoder)
+    note_queue: asyncio.Queue[list[NoteRefs] | None] = asyncio.Queue(queue_size)
+    file_queue: asyncio.Queue[FileToWrite | None] = asyncio.Queue(queue_size)
+    state = ExportProgress(0, 0, 0, 0, 0, 0, 0, totals_known=False)
+    start = time.perf_counter()
+    report_progress = ProgressReporter(progress, state)
+    first_writes: FirstWrites[asyncio.Future] = FirstWrites(exporter.folder_groups > 1)
+
+    def is_cancelled() -> bool:
+        return cancelled is not None and cancelled()
+
+    def file_to_write(
+        folder: Path, filename: str, src_path: str, first: bool
+    ) -> FileToWrite:
+        link_to = first_writes.link_to(filename, first)
+        written = None
+        if first and first_writes.link_copies:
+            written = loop.create_future()
+            first_writes.add(filename, written)
+        return FileToWrite(folder, filename, src_path, link_to, written)
+
+    async def close_file_queue() -> None:
+        if is_cancelled():
+            # Drop files that weren't written yet
+            while not file_queue.empty():
+                file_queue.get_nowait()
+        for _ in range(writers):
+            await file_queue.put(None)
+
+    async def produce_notes(scanner: _Scanner) -> None:
+        try:
+            batch: list[NoteRefs] | None = await on_collection_thread(scanner.start)
+            while batch is not None and not is_cancelled():
+                await note_queue.put(batch)
+                batch = await on_collection_thread(scanner.next_batch)
+            if batch is None:
+                await note_queue.put(await on_collection_thread(scanner.finish))
+        finally:
+            await note_queue.put(None)
+
+    async def resolve_files() -> None:
+        names = scan.names
+        resolver = exporter.resolver()
+        try:
+            while True:
+                batch = await note_queue.get()
+                if batch is None:
+                    break
+                if is_cancelled():
+                    # Keep taking batches until the producer notices
+                    continue
+                # The files of the batch were added to the scan before it was queued
+                resolver.grow()
+                for nid, refs, folders in batch:
+                    stats.count(references=len(refs))
+                    for group, folder in folders:
+                        for name_id, src_path, first in resolver.resolve(refs, group):
+                            state.file_count += 1
+                            await file_queue.put(
+                                file_to_write(folder, names[name_id], src_path, first)
+                            )
+                    if nid is not None:
+                        state.notes_done += 1
+                    report_progress()
+                await asyncio.to_thread(sink.flush)
+        finally:
+            stats.count(
+                duplicates=resolver.duplicates,
+                filtered=resolver.filtered,
+                missing=len(resolver.missing),
+            )
+            await close_file_queue()
+
+    async def write_files() -> None:
+        while True:
+            item = await file_queue.get()
+            if item is None:
+                break
+            if item.link_to is None:
+                result = await asyncio.to_thread(
+                    writer.write, item.src_path, item.folder, item.filename
+                )
+                size = scan.files.size(item.filename) or 0
+            else:
+                result = await asyncio.to_thread(
+                    writer.link, await item.link_to, item.folder
+                )
+                size = 0
+            if item.written is not None:
+                item.written.set_result(result)
+            stats.count(exported=int(result is not None), missing=int(result is None))
+            state.files_done += 1
+            state.bytes_done += size
+            report_progress()
+
+    async def feed_plan() -> None:
+        def make_plan() -> ExportPlan:
+            with stats.timed("plan"):
+                return exporter.plan()
+
+        plan = await on_collection_thread(make_plan)
+        state.file_count = plan.file_count
+        state.total_bytes = plan.total_bytes
+        state.totals_known = True
+        stats.count(
+            references=plan.references,
+            duplicates=plan.duplicates,
+            filtered=plan.filtered,
+            missing=len(plan.missing),
+        )
+        first_writes.link_copies = any(not planned.first for planned in plan.files)
+        try:
+            for planned in plan.files:
+                if is_cancelled():
+                    break
+                await file_queue.put(
+                    file_to_write(
+                        planned.folder,
+                        planned.filename,
+                        planned.src_path,
+                        planned.first,
+                    )
+                )
+                state.notes_done = min(planned.note_index + 1, state.note_count)
+                report_progress()
+        finally:
+            await close_file_queue()
+
+    try:
+        state.note_count = await on_collection_thread(lambda: exporter.note_count)
+        if streaming:
+            scanner = await on_collection_thread(_Scanner, exporter)
+            # List the media folder before its first lookup on the event loop
+            await asyncio.to_thread(lambda: scan.files.entries)
+            stages = [produce_notes(scanner), resolve_files()]
+        else:
+            stages = [feed_plan()]
+        # Created once the scanner exists, as starting a new scan replaces the folder listing
+        writer = ExportWriter(sink, stats, transcoder, scan.files)
+        tasks = [asyncio.ensure_future(stage) for stage in stages]
+        tasks.extend(asyncio.ensure_future(write_files()) for _ in range(writers))
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        state.totals_known = True
+        state.total_bytes = state.bytes_done
+        report_progress(finished=True)
+    finally:
+        await asyncio.to_thread(sink.close)
+        col_executor.shutdown(wait=True)
+        stats.phases["export"] = time.perf_counter() - start
+    result = exporter.scan_stats.copy()
+    result.add(stats)
+    exporter.stats = result
+    return result
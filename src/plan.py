@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import csv
+import json
+import os
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import NamedTuple
+
+
+class PlannedFile(NamedTuple):
+    """A file to be exported."""
+
+    # Index of the note referencing it first in export order
+    note_index: int
+    # Relative to the export's root
+    folder: Path
+    filename: str
+    src_path: str
+    size: int
+    # Whether this is the first copy of the file, as opposed to a copy linked to it
+    first: bool
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class ExportPlan:
+    """
+    Files an export will write, worked out from a scan without writing anything.
+    Returned by `MediaExporter.plan()` and accepted by `MediaExporter.export()`.
+    """
+
+    note_count: int = 0
+    files: list[PlannedFile] = field(default_factory=list)
+    # Referenced files matching the filters that don't exist in the media folder
+    missing: list[str] = field(default_factory=list)
+    # Files referenced by more than one note and the number of notes referencing them
+    shared: dict[str, int] = field(default_factory=dict)
+    references: int = 0
+    # References skipped because the file was already exported to the same folder group
+    duplicates: int = 0
+    # Files excluded by the extension filter
+    filtered: int = 0
+
+    @property
+    def file_count(self) -> int:
+        return len(self.files)
+
+    @property
+    def total_bytes(self) -> int:
+        """Total size of the files to write, not counting copies linked to their first copy."""
+        return sum(file.size for file in self.files if file.first)
+
+    def extensions(self) -> dict[str, tuple[int, int]]:
+        """Return the number and total size of files to export per extension."""
+        counts: Counter[str] = Counter()
+        sizes: Counter[str] = Counter()
+        for file in self.files:
+            ext = os.path.splitext(file.filename)[1][1:]
+            counts[ext] += 1
+            sizes[ext] += file.size
+        return {ext: (counts[ext], sizes[ext]) for ext in sorted(counts)}
+
+    def folders(self) -> dict[str, tuple[int, int]]:
+        """Return the number and total size of files to export per folder."""
+        counts: Counter[str] = Counter()
+        sizes: Counter[str] = Counter()
+        for file in self.files:
+            folder = file.folder.as_posix()
+            counts[folder] += 1
+            sizes[folder] += file.size
+        return {folder: (counts[folder], sizes[folder]) for folder in sorted(counts)}
+
+    def summary(self) -> dict:
+        return {
+            "notes": self.note_count,
+            "files": self.file_count,
+            "bytes": self.total_bytes,
+            "references": self.references,
+            "duplicates": self.duplicates,
+            "filtered": self.filtered,
+            "missing": len(self.missing),
+            "shared": len(self.shared),
+            "extensions": {
+                ext: {"files": count, "bytes": size}
+                for ext, (count, size) in self.extensions().items()
+            },
+            "folders": {
+                folder: {"files": count, "bytes": size}
+                for folder, (count, size) in self.folders().items()
+            },
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            **self.summary(),
+            "files": [
+                {
+                    "folder": file.folder.as_posix(),
+                    "filename": file.filename,
+                    "size": file.size,
+                    "linked": not file.first,
+                }
+                for file in self.files
+            ],
+            "missing": self.missing,
+            "shared": self.shared,
+        }
+
+    def write_json(self, path: Path | str) -> None:
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=2, ensure_ascii=False)
+
+    def write_csv(self, path: Path | str) -> None:
+        """Write a row per file to export or missing file."""
+        with open(path, "w", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["status", "folder", "filename", "size", "notes"])
+            for planned in self.files:
+                writer.writerow(
+                    [
+                        "copy" if planned.first else "link",
+                        planned.folder.as_posix(),
+                        planned.filename,
+                        planned.size,
+                        self.shared.get(planned.filename, 1),
+                    ]
+                )
+            for filename in self.missing:
+                writer.writerow(
+                    ["missing", "", filename, "", self.shared.get(filename, 1)]
+                )
+
+    def write_report(self, path: Path | str) -> None:
+        """Write the plan as CSV or JSON depending on the extension of `path`."""
+        if str(path).lower().endswith(".csv"):
+            self.write_csv(path)
+        else:
+            self.write_json(path)
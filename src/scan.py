@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import itertools
+import os
+from array import array
+from collections import Counter
+from typing import Callable, Iterable, Iterator
+
+from anki.models import NotetypeId
+from anki.notes import NoteId
+
+from .media_dir import MediaDirIndex
+
+
+# pylint: disable=too-many-instance-attributes
+class MediaScan:
+    """
+    Media referenced by each field of a set of notes and by their notetypes.
+    A scan is gathered once and shared by exporters using different field and extension filters.
+
+    Filenames are interned in a table and referenced by their index in it.
+    The extension of each filename is split off once when it's interned and stored as an index
+    in a table of extensions, so filters by extension don't need to parse filenames again.
+    References are stored in flat arrays in CSR style: the references of field `j` of note `i`
+    are `refs[ref_offsets[k]:ref_offsets[k + 1]]` where `k = field_offsets[i] + j`.
+    """
+
+    def __init__(self, media_dir: str) -> None:
+        self.media_dir = media_dir
+        self.clear()
+
+    def clear(self) -> None:
+        # Listed again for each scan, as files might have been added or removed
+        self.files = MediaDirIndex(self.media_dir)
+        self.names: list[str] = []
+        self.name_ids: dict[str, int] = {}
+        # Extension table, and the index of the extension of each filename in `names`
+        self.ext_names: list[str] = []
+        self.ext_ids: dict[str, int] = {}
+        self.name_exts = array("I")
+        self.note_ids = array("q")
+        self.note_mids = array("q")
+        self.field_offsets = array("I", [0])
+        self.ref_offsets = array("I", [0])
+        self.refs = array("I")
+        self.notetype_media: dict[NotetypeId, array] = {}
+        # Number of distinct files per extension
+        self.extensions: Counter[str] = Counter()
+        # Total size in bytes and number of missing files per extension, of the files
+        # interned before the last call to `update_extension_sizes()`
+        self.extension_bytes: Counter[str] = Counter()
+        self.extension_missing: Counter[str] = Counter()
+        self._sized_count = 0
+        self.complete = False
+
+    def intern(self, filename: str) -> int:
+        """Return the ID of `filename`, adding it to the filename table if needed."""
+        name_id = self.name_ids.get(filename)
+        if name_id is None:
+            name_id = len(self.names)
+            self.names.append(filename)
+            self.name_ids[filename] = name_id
+            ext = os.path.splitext(filename)[1][1:]
+            ext_id = self.ext_ids.get(ext)
+            if ext_id is None:
+                ext_id = self.ext_ids[ext] = len(self.ext_names)
+                self.ext_names.append(ext)
+            self.name_exts.append(ext_id)
+            self.extensions[ext] += 1
+        return name_id
+
+    def update_extension_sizes(self) -> None:
+        """
+        Add the files interned since the last call to `extension_bytes` and `extension_missing`.
+        Files are only stat'd here on request, so exports don't stat files excluded by their filters.
+        """
+        names = self.names
+        for name_id in range(self._sized_count, len(names)):
+            ext = self.ext_names[self.name_exts[name_id]]
+            size = self.files.size(names[name_id])
+            if size is None:
+                self.extension_missing[ext] += 1
+            else:
+                self.extension_bytes[ext] += size
+        self._sized_count = len(names)
+
+    def names_extensions(self, name_mask: bytearray) -> set[str]:
+        """Return the extensions of the filenames set in `name_mask`, a mask over `names`."""
+        ext_names = self.ext_names
+        return {
+            ext_names[ext_id]
+            for ext_id in set(itertools.compress(self.name_exts, name_mask))
+        }
+
+    def add_note(
+        self, nid: NoteId, mid: NotetypeId, field_media: list[list[str]]
+    ) -> None:
+        self.note_ids.append(nid)
+        self.note_mids.append(mid)
+        for media in field_media:
+            self.refs.extend(self.intern(filename) for filename in media)
+            self.ref_offsets.append(len(self.refs))
+        self.field_offsets.append(len(self.ref_offsets) - 1)
+
+    def add_notetype(self, mid: NotetypeId, media: list[str]) -> None:
+        self.notetype_media[mid] = array("I", (self.intern(name) for name in media))
+
+    def note_refs(
+        self,
+        field_indices: Callable[[NotetypeId], list[int]] | None = None,
+        start: int = 0,
+    ) -> Iterator[tuple[NoteId, NotetypeId, list[array]]]:
+        """
+        Iterate over the ID, notetype ID and filename IDs of each field of each note, from the note at index `start`.
+        If `field_indices` is given, it's called with each notetype ID to get the indices of the fields to include.
+        """
+        refs = self.refs
+        ref_offsets = self.ref_offsets
+        field_offsets = self.field_offsets
+        note_ids = itertools.islice(self.note_ids, start, None)
+        note_mids = itertools.islice(self.note_mids, start, None)
+        for i, (nid, mid) in enumerate(zip(note_ids, note_mids), start):
+            start = field_offsets[i]
+            segments: Iterator[int] | range
+            if field_indices is None:
+                segments = range(start, field_offsets[i + 1])
+            else:
+                segments = (start + j for j in field_indices(NotetypeId(mid)))
+            yield NoteId(nid), NotetypeId(mid), [
+                refs[ref_offsets[k] : ref_offsets[k + 1]] for k in segments
+            ]
+
+
+class ReferenceResolver:
+    """
+    Works out which media references of an export are written: references to files already
+    written to the same folder group, filtered out by extension or missing are skipped and counted.
+    Shared by `MediaExporter.plan()` and the export pipeline, which resolves references while the scan grows.
+    """
+
+    def __init__(self, scan: MediaScan, exts: set | None, folder_groups: int) -> None:
+        self.scan = scan
+        self.exts = exts
+        self.duplicates = 0
+        self.filtered = 0
+        # Names of missing files, without duplicates
+        self.missing: list[str] = []
+        # Masks over the extensions and filenames of the scan
+        self._included = bytearray()
+        self._seen = [bytearray() for _ in range(folder_groups)]
+        self.resolved = bytearray()
+        self.missing_ids = bytearray()
+        self.grow()
+
+    def grow(self) -> None:
+        """Extend the masks to filenames added to the scan since the last call."""
+        scan = self.scan
+        if self.exts is not None:
+            self._included.extend(
+                ext in self.exts for ext in scan.ext_names[len(self._included) :]
+            )
+        added = len(scan.names) - len(self.resolved)
+        if added <= 0:
+            return
+        padding = bytes(added)
+        for seen in self._seen:
+            seen.extend(padding)
+        self.resolved.extend(padding)
+        self.missing_ids.extend(padding)
+
+    def resolve(
+        self, refs: Iterable[int], group: int
+    ) -> Iterator[tuple[int, str, bool]]:
+        """
+        Yield the filename ID, path and whether it's the first copy of each file in `refs` to write
+        to a folder of `group`. The filenames must have been added to the scan before the last call to `grow()`.
+        """
+        names = self.scan.names
+        name_exts = self.scan.name_exts
+        files = self.scan.files
+        included = self._included if self.exts is not None else None
+        seen = self._seen[group]
+        for name_id in refs:
+            if seen[name_id]:
+                self.duplicates += 1
+                continue
+            seen[name_id] = 1
+            if included is not None and not included[name_exts[name_id]]:
+                self.filtered += 1
+                continue
+            filename = names[name_id]
+            src_path = files.path(filename)
+            if src_path is None:
+                if not self.missing_ids[name_id]:
+                    self.missing_ids[name_id] = 1
+                    self.missing.append(filename)
+                continue
+            yield name_id, src_path, not self.resolved[name_id]
+            self.resolved[name_id] = 1
@@ -0,0 +1,379 @@
+from __future__ import annotations
+
+import os
+import shutil
+import stat as stat_module
+import tarfile
+import threading
+import time
+import zipfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+from types import TracebackType
+from typing import TypeVar
+
+from .fileops import COPY_CHUNK_SIZE, LINK_MODE_COPY, LINK_MODE_LINK, place_file
+from .manifest import ExportManifest, check_media_file
+from .stats import ExportStats
+
+# Extensions of files that are already compressed, so deflating them is a waste of time
+DEFAULT_STORED_EXTS = {
+    "7z",
+    "aac",
+    "avi",
+    "avif",
+    "flac",
+    "gif",
+    "gz",
+    "heic",
+    "jpeg",
+    "jpg",
+    "m4a",
+    "mkv",
+    "mov",
+    "mp3",
+    "mp4",
+    "oga",
+    "ogg",
+    "ogv",
+    "opus",
+    "pdf",
+    "png",
+    "webm",
+    "webp",
+    "woff",
+    "woff2",
+    "zip",
+}
+
+
+# Archive formats supported by `make_archive_sink()` and their file extensions
+ARCHIVE_FORMATS = {"zip": ".zip", "tar": ".tar", "tar.gz": ".tar.gz"}
+
+SinkT = TypeVar("SinkT", bound="ExportSink")
+
+
+def _source_stat(src_path: str, stat: os.stat_result | None) -> os.stat_result | None:
+    """Return `stat`, or stat `src_path` if it wasn't done yet. Returns None if the file doesn't exist."""
+    if stat is not None:
+        return stat
+    try:
+        return os.stat(src_path)
+    except FileNotFoundError:
+        return None
+
+
+class ExportSink(ABC):
+    """Destination that exported media files are written to."""
+
+    # Whether `write()` can be called from multiple threads at once
+    concurrent = False
+    # Set by `MediaExporter.export()` to record the number of bytes written, etc.
+    stats: ExportStats | None = None
+
+    def _count(self, **counts: int) -> None:
+        if self.stats is not None:
+            self.stats.count(**counts)
+
+    @abstractmethod
+    def write(
+        self, src_path: str, name: str, stat: os.stat_result | None = None
+    ) -> bool:
+        """
+        Write the file at `src_path` to the sink under `name`, a relative POSIX path.
+        `stat` is the result of stat-ing `src_path` if the caller already did, so it isn't done again.
+        Returns False if `src_path` doesn't exist.
+        """
+
+    def link(
+        self,
+        src_path: str,
+        name: str,
+        target_name: str,
+        stat: os.stat_result | None = None,
+    ) -> bool:
+        """
+        Write a copy of `target_name`, a file already written to the sink from `src_path`, under `name`.
+        Sinks that support links write a link instead of the file's contents.
+        """
+        return self.write(src_path, name, stat)
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self: SinkT) -> SinkT:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        self.close()
+
+
+# pylint: disable=too-many-instance-attributes
+class FolderSink(ExportSink):
+    """
+    Sink that copies files to a folder.
+    If `incremental` is True, a manifest of exported files is kept in the folder
+    and files that didn't change since the last export are not copied again.
+    `hashes` additionally records content hashes to detect files that were touched but not changed.
+    `link_mode` is one of `fileops.LINK_MODES` and controls how files are placed in the folder.
+    If `dedupe` is True, files with identical contents are written once and hard-linked to each other.
+    """
+
+    concurrent = True
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        folder: Path | str,
+        incremental: bool = True,
+        hashes: bool = False,
+        link_mode: str = LINK_MODE_COPY,
+        dedupe: bool = False,
+    ) -> None:
+        self.folder = Path(folder)
+        self.hashes = hashes or dedupe
+        self.link_mode = link_mode
+        self.dedupe = dedupe
+        self.manifest = ExportManifest(self.folder) if incremental else None
+        self._lock = threading.Lock()
+        self._created_folders: set[Path] = set()
+        # Path of the first file written with each content hash, and an event set once it's written
+        self._payloads: dict[str, tuple[str, threading.Event]] = {}
+
+    def _ensure_folder(self, folder: Path) -> None:
+        with self._lock:
+            if folder in self._created_folders:
+                return
+        # Only marked as created afterwards, so other threads don't write to it before it exists
+        folder.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self._created_folders.add(folder)
+
+    def _place_payload(
+        self, src_path: str, dest_path: str, sha1: str, size: int
+    ) -> None:
+        """Write `dest_path`, hard-linking it to a file with the same contents written earlier if any."""
+        with self._lock:
+            payload = self._payloads.get(sha1)
+            if payload is None:
+                done = threading.Event()
+                self._payloads[sha1] = (dest_path, done)
+        if payload is None:
+            try:
+                place_file(src_path, dest_path, self.link_mode)
+            finally:
+                done.set()
+            self._count(bytes_written=size)
+            return
+        first_path, first_done = payload
+        first_done.wait()
+        if os.path.exists(first_path):
+            place_file(first_path, dest_path, LINK_MODE_LINK)
+            self._count(linked=1)
+        else:
+            place_file(src_path, dest_path, self.link_mode)
+            self._count(bytes_written=size)
+
+    def write(
+        self, src_path: str, name: str, stat: os.stat_result | None = None
+    ) -> bool:
+        dest_path = self.folder / name
+        self._ensure_folder(dest_path.parent)
+        previous = self.manifest.get(name) if self.manifest else None
+        try:
+            result = check_media_file(
+                src_path, str(dest_path), previous, self.hashes, stat
+            )
+            if result is None:
+                return False
+            entry, up_to_date = result
+            if up_to_date:
+                self._count(unchanged=1)
+            if self.dedupe and entry.sha1:
+                if up_to_date:
+                    with self._lock:
+                        done = threading.Event()
+                        done.set()
+                        self._payloads.setdefault(entry.sha1, (str(dest_path), done))
+                else:
+                    self._place_payload(
+                        src_path, str(dest_path), entry.sha1, entry.size
+                    )
+            elif not up_to_date:
+                place_file(src_path, str(dest_path), self.link_mode)
+                self._count(bytes_written=entry.size)
+        except FileNotFoundError:
+            # Deleted since it was stat'd
+            return False
+        if self.manifest:
+            with self._lock:
+                self.manifest.record(name, entry)
+        return True
+
+    def link(
+        self,
+        src_path: str,
+        name: str,
+        target_name: str,
+        stat: os.stat_result | None = None,
+    ) -> bool:
+        dest_path = self.folder / name
+        self._ensure_folder(dest_path.parent)
+        previous = self.manifest.get(name) if self.manifest else None
+        try:
+            result = check_media_file(
+                src_path, str(dest_path), previous, self.hashes, stat
+            )
+            if result is None:
+                return False
+            entry, up_to_date = result
+            if up_to_date:
+                self._count(unchanged=1)
+            else:
+                target_path = self.folder / target_name
+                if target_path.exists():
+                    place_file(str(target_path), str(dest_path), LINK_MODE_LINK)
+                    self._count(linked=1)
+                else:
+                    place_file(src_path, str(dest_path), self.link_mode)
+                    self._count(bytes_written=entry.size)
+        except FileNotFoundError:
+            return False
+        if self.manifest:
+            with self._lock:
+                self.manifest.record(name, entry)
+        return True
+
+    def remove(self, name: str) -> bool:
+        """Delete file `name` from the folder and the manifest. Returns False if it doesn't exist."""
+        if self.manifest:
+            with self._lock:
+                self.manifest.forget(name)
+        try:
+            os.unlink(self.folder / name)
+        except FileNotFoundError:
+            return False
+        self._count(removed=1)
+        return True
+
+    def flush(self) -> None:
+        if self.manifest:
+            with self._lock:
+                self.manifest.flush()
+
+    def close(self) -> None:
+        if self.manifest:
+            self.manifest.close()
+
+
+class ZipSink(ExportSink):
+    """
+    Sink that streams files into a ZIP archive.
+    Files with extensions in `stored_exts` are stored as is; others are deflated.
+    """
+
+    def __init__(self, path: Path | str, stored_exts: set[str] | None = None) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.stored_exts = DEFAULT_STORED_EXTS if stored_exts is None else stored_exts
+        self._zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED)
+
+    def write(
+        self, src_path: str, name: str, stat: os.stat_result | None = None
+    ) -> bool:
+        stat = _source_stat(src_path, stat)
+        if stat is None:
+            return False
+        # Like `ZipFile.write()`, which would stat the file again
+        date_time = max(time.localtime(stat.st_mtime)[:6], (1980, 1, 1, 0, 0, 0))
+        info = zipfile.ZipInfo(name, date_time)
+        info.external_attr = (stat.st_mode & 0xFFFF) << 16
+        info.file_size = stat.st_size
+        ext = os.path.splitext(name)[1][1:].lower()
+        info.compress_type = (
+            zipfile.ZIP_STORED if ext in self.stored_exts else zipfile.ZIP_DEFLATED
+        )
+        try:
+            src = open(src_path, "rb")
+        except FileNotFoundError:
+            return False
+        # Copied in chunks, so memory use doesn't grow with file size
+        with src, self._zip.open(info, "w") as dest:
+            shutil.copyfileobj(src, dest, COPY_CHUNK_SIZE)
+        self._count(bytes_written=stat.st_size)
+        return True
+
+    def close(self) -> None:
+        self._zip.close()
+
+
+class TarSink(ExportSink):
+    """Sink that streams files into a tar archive, optionally compressed with `compression` ("gz", "bz2" or "xz")."""
+
+    def __init__(self, path: Path | str, compression: str = "") -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        mode = f"w:{compression}" if compression else "w"
+        self._tar = tarfile.open(path, mode)  # type: ignore[call-overload]
+
+    @staticmethod
+    def _tarinfo(name: str, stat: os.stat_result) -> tarfile.TarInfo:
+        # Built from `stat` rather than with `TarFile.gettarinfo()`, which would stat the file again
+        info = tarfile.TarInfo(name)
+        info.mode = stat_module.S_IMODE(stat.st_mode)
+        info.mtime = int(stat.st_mtime)
+        info.size = stat.st_size
+        return info
+
+    def write(
+        self, src_path: str, name: str, stat: os.stat_result | None = None
+    ) -> bool:
+        stat = _source_stat(src_path, stat)
+        if stat is None:
+            return False
+        try:
+            src = open(src_path, "rb")
+        except FileNotFoundError:
+            return False
+        with src:
+            self._tar.addfile(self._tarinfo(name, stat), src)
+        self._count(bytes_written=stat.st_size)
+        return True
+
+    def link(
+        self,
+        src_path: str,
+        name: str,
+        target_name: str,
+        stat: os.stat_result | None = None,
+    ) -> bool:
+        stat = _source_stat(src_path, stat)
+        if stat is None:
+            return False
+        info = self._tarinfo(name, stat)
+        info.type = tarfile.LNKTYPE
+        info.linkname = target_name
+        info.size = 0
+        self._tar.addfile(info)
+        self._count(linked=1)
+        return True
+
+    def close(self) -> None:
+        self._tar.close()
+
+
+def make_archive_sink(path: Path | str, archive_format: str) -> ExportSink:
+    """Return a sink for an archive in one of `ARCHIVE_FORMATS`."""
+    if archive_format == "zip":
+        return ZipSink(path)
+    if archive_format == "tar":
+        return TarSink(path)
+    if archive_format == "tar.gz":
+        return TarSink(path, "gz")
+    raise ValueError(f"unsupported archive format: {archive_format}")
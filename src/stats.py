@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import copy
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+# Counters recorded during scans and exports, in the order they are reported
+COUNTERS = {
+    "notes": "notes scanned",
+    "notes_cached": "notes read from the index",
+    "references": "media references",
+    "duplicates": "duplicate references skipped",
+    "filtered": "files excluded by extension",
+    "exported": "files exported",
+    "unchanged": "unchanged files skipped",
+    "missing": "missing files",
+    "linked": "files linked to identical files",
+    "transcoded": "files converted",
+    "transcode_cached": "converted files taken from the cache",
+    "transcode_failed": "files that failed to convert",
+    "removed": "files removed from the export folder",
+    "bytes_written": "bytes written",
+}
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class ExportProgress:
+    """Progress of an export, passed to the progress callback of `MediaExporter.export()`."""
+
+    notes_done: int
+    note_count: int
+    files_done: int
+    file_count: int
+    bytes_done: int
+    total_bytes: int
+    # Seconds since the export started
+    elapsed: float
+    finished: bool = False
+    # False if notes are still being scanned, in which case `file_count` and `total_bytes` are unknown
+    totals_known: bool = True
+
+    @property
+    def fraction(self) -> float:
+        """
+        Fraction of the export done, by bytes if the files have any contents, otherwise by files,
+        or by notes if the totals are not known yet.
+        """
+        if self.finished:
+            return 1.0
+        if not self.totals_known:
+            return (
+                min(self.notes_done / self.note_count, 1.0) if self.note_count else 0.0
+            )
+        if self.total_bytes:
+            return min(self.bytes_done / self.total_bytes, 1.0)
+        if self.file_count:
+            return min(self.files_done / self.file_count, 1.0)
+        return 0.0
+
+    @property
+    def throughput(self) -> float:
+        """Bytes processed per second."""
+        return self.bytes_done / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def eta(self) -> float | None:
+        """Estimated seconds left, or None if nothing was processed yet."""
+        if self.finished:
+            return 0.0
+        if not self.totals_known or not self.bytes_done or not self.elapsed:
+            return None
+        return max(self.total_bytes - self.bytes_done, 0) / self.throughput
+
+    def describe(self) -> str:
+        if self.totals_known:
+            text = (
+                f"Exported {self.files_done} of {self.file_count} files "
+                f"({format_size(self.bytes_done)} of {format_size(self.total_bytes)}"
+            )
+        else:
+            text = (
+                f"Scanned {self.notes_done} of {self.note_count} notes, "
+                f"exported {self.files_done} files ({format_size(self.bytes_done)}"
+            )
+        if self.throughput:
+            text += f", {format_size(self.throughput)}/s"
+        eta = self.eta
+        if eta is not None and not self.finished:
+            text += f", about {format_duration(eta)} left"
+        return text + ")"
+
+
+def format_duration(seconds: float) -> str:
+    seconds = round(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes}m {seconds}s"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes}m"
+
+
+class ExportStats:
+    """
+    Wall time spent in each phase of a scan or export, and counters of processed notes and files.
+    Counters can be updated from copy threads. Phases timed in copy threads, such as "write",
+    are summed over all threads, so they can exceed the wall time of the export.
+    """
+
+    def __init__(self) -> None:
+        self.phases: defaultdict[str, float] = defaultdict(float)
+        self.counters: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def timed(self, phase: str) -> Iterator[None]:
+        """Add the time spent in the block to `phase`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[phase] += elapsed
+
+    def clear(self) -> None:
+        with self._lock:
+            self.phases.clear()
+            self.counters.clear()
+
+    def count(self, **counts: int) -> None:
+        with self._lock:
+            self.counters.update(counts)
+
+    def add(self, other: ExportStats) -> None:
+        """Add the phases and counters of `other` to these stats."""
+        with self._lock:
+            for phase, seconds in other.phases.items():
+                self.phases[phase] += seconds
+            self.counters.update(other.counters)
+
+    def copy(self) -> ExportStats:
+        stats = ExportStats()
+        with self._lock:
+            stats.phases = copy.copy(self.phases)
+            stats.counters = copy.copy(self.counters)
+        return stats
+
+    @property
+    def seconds(self) -> float:
+        """Wall time of the export, excluding the scan if it was done beforehand."""
+        return self.phases.get("export", 0.0)
+
+    @property
+    def throughput(self) -> float:
+        """Bytes written per second."""
+        return self.counters["bytes_written"] / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        counters = ", ".join(
+            f"{self.counters[name]} {label}"
+            for name, label in COUNTERS.items()
+            if name != "bytes_written" and self.counters[name]
+        )
+        phases = ", ".join(
+            f"{phase} {seconds:.3f}s" for phase, seconds in self.phases.items()
+        )
+        return (
+            f"Wrote {format_size(self.counters['bytes_written'])} in {self.seconds:.3f}s "
+            f"({format_size(self.throughput)}/s); {counters}; phases: {phases}"
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "phases": {phase: round(sec, 6) for phase, sec in self.phases.items()},
+            "counters": {name: self.counters[name] for name in COUNTERS},
+        }
@@ -0,0 +1,259 @@
+"""Optional conversion of media files while exporting them, e.g. to make exports smaller for mobile devices."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from concurrent.futures import (
+    BrokenExecutor,
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from .manifest import file_sha1
+from .media_dir import MediaDirIndex, normalize_filename
+
+# Extensions of files that can be resized and recompressed with Pillow
+IMAGE_EXTS = {"jpg", "jpeg", "png", "webp", "bmp", "tif", "tiff"}
+# Extensions of files that can be converted with ffmpeg
+AUDIO_EXTS = {"mp3", "ogg", "oga", "opus", "wav", "m4a", "aac", "flac"}
+
+# Pillow format names of image extensions
+PIL_FORMATS = {
+    "jpg": "JPEG",
+    "jpeg": "JPEG",
+    "png": "PNG",
+    "webp": "WEBP",
+    "bmp": "BMP",
+    "tif": "TIFF",
+    "tiff": "TIFF",
+}
+
+
+def pillow_available() -> bool:
+    try:
+        import PIL.Image  # pylint: disable=unused-import,import-outside-toplevel
+    except ImportError:
+        return False
+    return True
+
+
+def find_ffmpeg() -> str | None:
+    return shutil.which("ffmpeg")
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass(frozen=True)
+class TranscodeOptions:
+    """Conversions applied to exported files."""
+
+    # Resize and recompress images with Pillow
+    images: bool = False
+    # Maximum width and height of images, or 0 to keep their size
+    image_max_size: int = 1600
+    image_quality: int = 80
+    # Convert audio files with ffmpeg
+    audio: bool = False
+    audio_format: str = "mp3"
+    audio_bitrate: str = "96k"
+
+    def key(self, kind: str) -> str:
+        """Hash of the options affecting files of `kind`, used in cache keys."""
+        if kind == "image":
+            params = [kind, self.image_max_size, self.image_quality]
+        else:
+            params = [kind, self.audio_format, self.audio_bitrate]
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()[:16]
+
+
+def transcode_image(
+    src_path: str, dest_path: str, ext: str, max_size: int, quality: int
+) -> None:
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+
+    with Image.open(src_path) as image:
+        if max_size:
+            image.thumbnail((max_size, max_size))
+        image_format = PIL_FORMATS[ext]
+        output: Image.Image = image
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            output = image.convert("RGB")
+        output.save(dest_path, format=image_format, quality=quality, optimize=True)
+
+
+def transcode_audio(ffmpeg: str, src_path: str, dest_path: str, bitrate: str) -> None:
+    subprocess.run(
+        [
+            ffmpeg,
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-y",
+            "-i",
+            src_path,
+            "-vn",
+            "-b:a",
+            bitrate,
+            dest_path,
+        ],
+        check=True,
+        capture_output=True,
+    )
+
+
+def transcode_file(
+    src_path: str, dest_path: str, kind: str, options: TranscodeOptions, ffmpeg: str
+) -> None:
+    """
+    Convert `src_path` to `dest_path` according to `options`. Run in a worker process.
+    If the converted image is larger than the original, the original is kept.
+    """
+    tmp_path = f"{dest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        if kind == "image":
+            ext = os.path.splitext(src_path)[1][1:].lower()
+            transcode_image(
+                src_path, tmp_path, ext, options.image_max_size, options.image_quality
+            )
+            if os.path.getsize(tmp_path) >= os.path.getsize(src_path):
+                shutil.copyfile(src_path, tmp_path)
+        else:
+            # ffmpeg picks the output format from the extension
+            tmp_path += f".{options.audio_format}"
+            transcode_audio(ffmpeg, src_path, tmp_path, options.audio_bitrate)
+        # Written under a temporary name so that interrupted conversions are never used
+        os.replace(tmp_path, dest_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+class Transcoder:
+    """
+    Converts files with `options` in a pool of processes, caching the results in `cache_dir`
+    by the hash of the original file and the options.
+    Images are skipped if Pillow is not installed and audio files if ffmpeg is not found.
+    If the process pool breaks, e.g. because workers can't be started, conversions continue in threads.
+    Conversions that fail raise one of `errors`, after which files are exported unchanged.
+    """
+
+    def __init__(
+        self, options: TranscodeOptions, cache_dir: Path | str, workers: int = 0
+    ) -> None:
+        self.options = options
+        self.cache_dir = Path(cache_dir)
+        self.images = options.images and pillow_available()
+        self.ffmpeg = find_ffmpeg() if options.audio else None
+        self.workers = workers or os.cpu_count() or 1
+        self._executor: Executor | None = None
+        self._use_threads = False
+        self._lock = threading.Lock()
+        self.errors: tuple[type[BaseException], ...] = (
+            OSError,
+            ValueError,
+            subprocess.CalledProcessError,
+            BrokenExecutor,
+        )
+        if self.images:
+            # pylint: disable=import-outside-toplevel
+            from PIL.Image import DecompressionBombError
+
+            self.errors += (DecompressionBombError,)
+
+    @property
+    def executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                # Bundled Anki builds can't start Python subprocesses
+                if getattr(sys, "frozen", False) or self._use_threads:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _fall_back_to_threads(self, broken: Executor) -> None:
+        """Replace `broken`, a process pool that died or couldn't start workers, with a thread pool."""
+        with self._lock:
+            self._use_threads = True
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, *args: Any) -> None:
+        executor = self.executor
+        try:
+            executor.submit(transcode_file, *args).result()
+        except BrokenProcessPool:
+            self._fall_back_to_threads(executor)
+            self.executor.submit(transcode_file, *args).result()
+
+    def kind(self, filename: str) -> str | None:
+        """Return "image" or "audio" if `filename` is converted, otherwise None."""
+        ext = os.path.splitext(filename)[1][1:].lower()
+        if self.images and ext in IMAGE_EXTS:
+            return "image"
+        if self.ffmpeg and ext in AUDIO_EXTS and ext != self.options.audio_format:
+            return "audio"
+        return None
+
+    def output_name(self, filename: str) -> str:
+        """Return the name `filename` is exported under."""
+        if self.kind(filename) == "audio":
+            return f"{os.path.splitext(filename)[0]}.{self.options.audio_format}"
+        return filename
+
+    def _name_taken(self, name: str, filename: str, files: MediaDirIndex) -> bool:
+        """Whether a file in `files` other than `filename` is exported as `name`."""
+        stem = os.path.splitext(name)[0]
+        entries = files.entries
+        return any(
+            normalize_filename(other) in entries
+            for other in [name, *(f"{stem}.{ext}" for ext in AUDIO_EXTS)]
+            if other != filename and self.output_name(other) == name
+        )
+
+    def transcode(
+        self, src_path: str, filename: str, files: MediaDirIndex | None = None
+    ) -> tuple[str, str, str | None]:
+        """
+        Convert `src_path` if needed, waiting for the conversion to finish.
+        Returns the path of the file to export, its name and "converted", "cached" or None if it's not converted.
+        If `files`, the media folder, has another file exported under the converted file's name,
+        e.g. foo.mp3 for foo.wav, the file isn't converted so that neither overwrites the other.
+        """
+        kind = self.kind(filename)
+        if kind is None:
+            return src_path, filename, None
+        name = self.output_name(filename)
+        if (
+            name != filename
+            and files is not None
+            and self._name_taken(name, filename, files)
+        ):
+            return src_path, filename, None
+        ext = os.path.splitext(name)[1]
+        cache_path = (
+            self.cache_dir / f"{file_sha1(src_path)}-{self.options.key(kind)}{ext}"
+        )
+        if cache_path.exists():
+            return str(cache_path), name, "cached"
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._run(src_path, str(cache_path), kind, self.options, self.ffmpeg or "")
+        return str(cache_path), name, "converted"
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,154 @@
+"""
+Benchmark the exporters on a synthetic collection.
+
+Example:
+    python -m tests.benchmarks.run --notes 50000 --output results.json
+    python -m tests.benchmarks.run --notes 50000 --compare results.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+import anki.buildinfo
+
+from src.exporter import DeckMediaExporter, MediaExporter, NoteMediaExporter
+
+from .synthetic import SyntheticParams, make_collection
+
+PHASES = ["all_fields", "all_extensions", "media_lists", "export"]
+
+
+def run_phases(
+    make_exporter: Callable[[], MediaExporter], export_dir: Path, track_memory: bool
+) -> dict[str, dict[str, float]]:
+    """Run the phases in order on a fresh exporter, as the export dialog does, and measure each."""
+    exporter = make_exporter()
+    phases: dict[str, Callable[[], Any]] = {
+        "all_fields": exporter.all_fields,
+        "all_extensions": exporter.all_extensions,
+        "media_lists": lambda: sum(1 for _ in exporter.media_lists),
+        "export": lambda: sum(
+            1 for _ in exporter.export(export_dir, incremental=False)
+        ),
+    }
+    results = {}
+    for name in PHASES:
+        if track_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        phases[name]()
+        result = {"seconds": time.perf_counter() - start}
+        if track_memory:
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[name] = result
+    return results
+
+
+def run(params: SyntheticParams, track_memory: bool) -> dict[str, Any]:
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp_path = Path(tmp)
+        start = time.perf_counter()
+        col, did = make_collection(str(tmp_path / "collection.anki2"), params)
+        setup_seconds = time.perf_counter() - start
+        try:
+            start = time.perf_counter()
+            notes = [col.get_note(nid) for nid in col.find_notes("")]
+            load_notes_seconds = time.perf_counter() - start
+            exporters: dict[str, Callable[[], MediaExporter]] = {
+                "deck": lambda: DeckMediaExporter(col, did),
+                "deck_subfolders": lambda: DeckMediaExporter(
+                    col, did, organize_into_subfolders=True
+                ),
+                "notes": lambda: NoteMediaExporter(col, notes),
+            }
+            results = {}
+            for name, make_exporter in exporters.items():
+                results[name] = run_phases(
+                    make_exporter, tmp_path / f"export_{name}", track_memory
+                )
+        finally:
+            col.close()
+    return {
+        "meta": {
+            "params": dataclasses.asdict(params),
+            "track_memory": track_memory,
+            "python": platform.python_version(),
+            "anki": anki.buildinfo.version,
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "setup_seconds": setup_seconds,
+            "load_notes_seconds": load_notes_seconds,
+        },
+        "results": results,
+    }
+
+
+def print_comparison(old: dict[str, Any], new: dict[str, Any]) -> None:
+    print(
+        f"{'exporter':<16} {'phase':<16} {'old (s)':>10} {'new (s)':>10} {'ratio':>8}"
+    )
+    for exporter, phases in new["results"].items():
+        for phase, result in phases.items():
+            old_result = old["results"].get(exporter, {}).get(phase)
+            if old_result is None:
+                continue
+            ratio = (
+                result["seconds"] / old_result["seconds"]
+                if old_result["seconds"]
+                else 0
+            )
+            print(
+                f"{exporter:<16} {phase:<16} {old_result['seconds']:>10.3f} {result['seconds']:>10.3f} {ratio:>8.2f}"
+            )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    for field in dataclasses.fields(SyntheticParams):
+        parser.add_argument(
+            f"--{field.name.replace('_', '-')}", type=int, default=field.default
+        )
+    parser.add_argument(
+        "--no-memory",
+        dest="track_memory",
+        action="store_false",
+        help="don't record peak memory, which slows down the benchmarks",
+    )
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument(
+        "--compare", help="compare the timings with the results in this JSON file"
+    )
+    args = parser.parse_args(argv)
+    params = SyntheticParams(
+        **{
+            field.name: getattr(args, field.name)
+            for field in dataclasses.fields(SyntheticParams)
+        }
+    )
+    results = run(params, args.track_memory)
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), encoding="utf-8")
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        if old["meta"]["params"] != results["meta"]["params"]:
+            print("warning: the results were produced with different parameters")
+        print_comparison(old, results)
+    elif not args.output:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
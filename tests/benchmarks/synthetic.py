@@ -0,0 +1,94 @@
+"""Generation of synthetic collections for benchmarking the exporters."""
+
+from __future__ import annotations
+
+import os
+import random
+from dataclasses import dataclass
+
+from anki.collection import AddNoteRequest, Collection
+from anki.decks import DeckId
+from anki.models import NotetypeDict
+
+MEDIA_EXTS = ["jpg", "png", "gif", "mp3", "ogg", "mp4"]
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class SyntheticParams:
+    notes: int = 10000
+    notetypes: int = 2
+    fields: int = 4
+    # Number of media references in each note, spread over its fields
+    refs_per_note: int = 2
+    media_files: int = 2000
+    # Sizes of media files are picked uniformly between these values
+    min_media_size: int = 1024
+    max_media_size: int = 64 * 1024
+    subdecks: int = 4
+    seed: int = 0
+
+
+def _add_notetype(col: Collection, index: int, field_count: int) -> NotetypeDict:
+    notetype = col.models.new(f"Synthetic {index}")
+    for i in range(field_count):
+        col.models.add_field(notetype, col.models.new_field(f"Field {i}"))
+    template = col.models.new_template("Card 1")
+    template["qfmt"] = '{{Field 0}}<script src="_synthetic.js"></script>'
+    template["afmt"] = "{{FrontSide}}<hr id=answer>{{Field 1}}"
+    col.models.add_template(notetype, template)
+    notetype["css"] += "\n@import '_synthetic.css';"
+    col.models.add_dict(notetype)
+    return col.models.by_name(notetype["name"])
+
+
+def _write_media(
+    col: Collection, params: SyntheticParams, rng: random.Random
+) -> list[str]:
+    media_dir = col.media.dir()
+    filenames = []
+    for i in range(params.media_files):
+        filename = f"synthetic_{i}.{MEDIA_EXTS[i % len(MEDIA_EXTS)]}"
+        size = rng.randint(params.min_media_size, params.max_media_size)
+        with open(os.path.join(media_dir, filename), "wb") as file:
+            file.write(rng.randbytes(size))
+        filenames.append(filename)
+    for filename in ("_synthetic.js", "_synthetic.css"):
+        with open(os.path.join(media_dir, filename), "w", encoding="utf-8") as file:
+            file.write("/* synthetic */")
+    return filenames
+
+
+def _reference(filename: str) -> str:
+    if filename.endswith((".mp3", ".ogg", ".mp4")):
+        return f"[sound:{filename}]"
+    return f'<img src="{filename}">'
+
+
+def make_collection(path: str, params: SyntheticParams) -> tuple[Collection, DeckId]:
+    """
+    Create a collection at `path` with notes referencing synthetic media files.
+    Returns the collection and the ID of the top-level deck containing all notes.
+    """
+    rng = random.Random(params.seed)
+    col = Collection(path)
+    filenames = _write_media(col, params, rng)
+    notetypes = [
+        _add_notetype(col, i, max(2, params.fields)) for i in range(params.notetypes)
+    ]
+    top_did = DeckId(col.decks.id("Synthetic"))
+    dids = [top_did] + [
+        DeckId(col.decks.id(f"Synthetic::Subdeck {i}")) for i in range(params.subdecks)
+    ]
+    requests = []
+    for i in range(params.notes):
+        notetype = notetypes[i % len(notetypes)]
+        note = col.new_note(notetype)
+        for j, _ in enumerate(note.fields):
+            note.fields[j] = f"Note {i} field {j}"
+        for _ in range(params.refs_per_note):
+            j = rng.randrange(len(note.fields))
+            note.fields[j] += _reference(rng.choice(filenames))
+        requests.append(AddNoteRequest(note=note, deck_id=dids[i % len(dids)]))
+    col.add_notes(requests)
+    return col, top_did
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Iterator, NamedTuple, cast
+
+import pytest
+from anki.collection import Collection
+from anki.decks import DeckId
+
+from src.media_dir import MediaDirIndex
+
+# Contents of the media files of the test collection; dup.jpg is identical to a.jpg
+MEDIA = {
+    "a.jpg": b"image a",
+    "b.png": b"image b" * 10,
+    "c.mp3": b"sound c" * 100,
+    "dup.jpg": b"image a",
+}
+
+
+class SampleCollection(NamedTuple):
+    col: Collection
+    path: Path
+    top: DeckId
+    sub: DeckId
+
+    @property
+    def media_dir(self) -> str:
+        return self.col.media.dir()
+
+
+def make_sample_collection(path: Path) -> SampleCollection:
+    """
+    Create a collection with media in deck "Top" and its subdeck "Top::Sub":
+    - Top: `<img src="a.jpg">` / `[sound:c.mp3]`
+    - Top::Sub: `<img src="a.jpg"><img src="b.png">` / ``
+    - Top::Sub: `<img src="dup.jpg">` / `<img src="missing.png">`
+    """
+    col = Collection(str(path))
+    for filename, data in MEDIA.items():
+        with open(os.path.join(col.media.dir(), filename), "wb") as file:
+            file.write(data)
+    top = DeckId(col.decks.id("Top"))
+    sub = DeckId(col.decks.id("Top::Sub"))
+    notetype = col.models.by_name("Basic")
+    for did, front, back in (
+        (top, '<img src="a.jpg">', "[sound:c.mp3]"),
+        (sub, '<img src="a.jpg"><img src="b.png">', ""),
+        (sub, '<img src="dup.jpg">', '<img src="missing.png">'),
+    ):
+        note = col.new_note(notetype)
+        note["Front"] = front
+        note["Back"] = back
+        col.add_note(note, did)
+    return SampleCollection(col, path, top, sub)
+
+
+@pytest.fixture
+def sample_col(tmp_path: Path) -> Iterator[SampleCollection]:
+    sample_col = make_sample_collection(tmp_path / "collection.anki2")
+    yield sample_col
+    if sample_col.col.db is not None:
+        sample_col.col.close()
+
+
+def exported_files(folder: Path) -> set[str]:
+    """Return the relative POSIX paths of the media files in `folder`, without the manifest."""
+    return {
+        path.relative_to(folder).as_posix()
+        for path in folder.rglob("*")
+        if path.is_file() and not path.name.startswith(".")
+    }
+
+
+class _CountingEntry:
+    """Directory entry that counts calls of `stat()`."""
+
+    def __init__(self, entry: os.DirEntry, counts: Counter) -> None:
+        self._entry = entry
+        self._counts = counts
+        self.name = entry.name
+        self.path = entry.path
+
+    def stat(self) -> os.stat_result:
+        self._counts["stats"] += 1
+        return self._entry.stat()
+
+
+@pytest.fixture
+def media_dir_calls(monkeypatch: pytest.MonkeyPatch) -> Counter:
+    """Count the listings of media folders and the stats of listed files."""
+    counts: Counter = Counter()
+    entries = MediaDirIndex.entries.fget  # type: ignore[attr-defined]
+
+    def counting_entries(index: MediaDirIndex) -> dict:
+        if index._entries is None:  # pylint: disable=protected-access
+            counts["listings"] += 1
+            index._entries = {  # pylint: disable=protected-access
+                name: cast(os.DirEntry, _CountingEntry(entry, counts))
+                for name, entry in entries(index).items()
+            }
+        return index._entries  # pylint: disable=protected-access
+
+    monkeypatch.setattr(MediaDirIndex, "entries", property(counting_entries))
+    return counts
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+import pytest
+
+from src.cli import main
+
+from .conftest import SampleCollection, exported_files
+
+
+def read_events(capsys: pytest.CaptureFixture) -> list[dict]:
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def run_cli(
+    sample_col: SampleCollection, capsys: pytest.CaptureFixture, *args: str
+) -> tuple[int, list[dict]]:
+    """Run the CLI on the sample collection, returning its exit code and the events it printed."""
+    if sample_col.col.db is not None:
+        # The CLI opens the collection itself
+        sample_col.col.close()
+    code = main([str(sample_col.path), *args])
+    return code, read_events(capsys)
+
+
+def test_export_events(
+    sample_col: SampleCollection, tmp_path: Path, capsys: pytest.CaptureFixture
+) -> None:
+    dest = tmp_path / "out"
+    code, events = run_cli(sample_col, capsys, str(dest), "--deck", "Top")
+    assert code == 0
+    assert events[0] == {"event": "start", "notes": 3}
+    assert events[-2]["event"] == "progress"
+    done = events[-1]
+    assert done["event"] == "done"
+    assert done["exported"] == 4
+    assert done["stats"]["counters"]["missing"] == 1
+    assert exported_files(dest) == {"a.jpg", "b.png", "c.mp3", "dup.jpg"}
+
+
+def test_pipeline_events(
+    sample_col: SampleCollection, tmp_path: Path, capsys: pytest.CaptureFixture
+) -> None:
+    code, events = run_cli(
+        sample_col, capsys, str(tmp_path / "out"), "--deck", "Top", "--pipeline"
+    )
+    assert code == 0
+    assert [event["event"] for event in events][0] == "start"
+    assert events[-1]["event"] == "done" and events[-1]["exported"] == 4
+
+
+def test_dry_run(
+    sample_col: SampleCollection, tmp_path: Path, capsys: pytest.CaptureFixture
+) -> None:
+    dest = tmp_path / "out"
+    code, events = run_cli(
+        sample_col,
+        capsys,
+        str(dest),
+        "--deck-tree",
+        "Top",
+        "--exts",
+        "jpg",
+        "--dry-run",
+    )
+    assert code == 0
+    plan = events[-1]
+    assert plan["event"] == "plan"
+    assert plan["files"] == 3
+    assert plan["filtered"] == 3
+    assert plan["folders"] == {
+        "Top": {"files": 1, "bytes": 7},
+        "Top__Sub": {"files": 2, "bytes": 14},
+    }
+    assert not dest.exists()
+
+
+@pytest.mark.parametrize(
+    "args",
+    [["--deck", "Nonexistent"], ["--search", "deck:Top ("]],
+)
+def test_errors(
+    sample_col: SampleCollection,
+    tmp_path: Path,
+    capsys: pytest.CaptureFixture,
+    args: list[str],
+) -> None:
+    code, events = run_cli(sample_col, capsys, str(tmp_path / "out"), *args)
+    assert code == 1
+    assert [event["event"] for event in events] == ["error"]
+
+
+def test_missing_collection(tmp_path: Path, capsys: pytest.CaptureFixture) -> None:
+    path = tmp_path / "typo.anki2"
+    code = main([str(path), str(tmp_path / "out"), "--deck", "Top"])
+    assert code == 1
+    assert [event["event"] for event in read_events(capsys)] == ["error"]
+    assert not path.exists()
+
+
+def test_locked_collection(
+    sample_col: SampleCollection, tmp_path: Path, capsys: pytest.CaptureFixture
+) -> None:
+    # Still open, like in a running Anki
+    code = main([str(sample_col.path), str(tmp_path / "out"), "--deck", "Top"])
+    assert code == 1
+    assert [event["event"] for event in read_events(capsys)] == ["error"]
@@ -0,0 +1,328 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import tarfile
+import zipfile
+from collections import Counter
+from pathlib import Path
+from typing import Callable
+
+import pytest
+
+from src import exporter as exporter_module
+from src import fileops
+from src.exporter import (
+    DeckMediaExporter,
+    MediaExporter,
+    MultiDeckMediaExporter,
+    SearchMediaExporter,
+)
+from src.fileops import LINK_MODE_LINK
+from src.manifest import ExportManifest
+from src.pipeline import export_async
+from src.sinks import ExportSink, FolderSink, TarSink, ZipSink, make_archive_sink
+
+from .conftest import MEDIA, SampleCollection, exported_files
+
+
+def run_export(exporter: MediaExporter, dest: Path | ExportSink) -> dict[str, int]:
+    for _ in exporter.export(dest):
+        pass
+    assert exporter.stats is not None
+    return exporter.stats.counters
+
+
+def test_export_deck(sample_col: SampleCollection, tmp_path: Path) -> None:
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top)
+    counters = run_export(exporter, tmp_path / "out")
+    assert exported_files(tmp_path / "out") == {"a.jpg", "b.png", "c.mp3", "dup.jpg"}
+    assert counters["references"] == 6
+    assert counters["duplicates"] == 1
+    assert counters["missing"] == 1
+    assert counters["exported"] == 4
+    assert (tmp_path / "out" / "c.mp3").read_bytes() == MEDIA["c.mp3"]
+
+
+def test_incremental_export_skips_unchanged_files(
+    sample_col: SampleCollection, tmp_path: Path
+) -> None:
+    dest = tmp_path / "out"
+    run_export(DeckMediaExporter(sample_col.col, sample_col.top), dest)
+    with open(os.path.join(sample_col.media_dir, "b.png"), "wb") as file:
+        file.write(b"changed")
+    counters = run_export(DeckMediaExporter(sample_col.col, sample_col.top), dest)
+    assert counters["unchanged"] == 3
+    assert counters["bytes_written"] == len(b"changed")
+    assert (dest / "b.png").read_bytes() == b"changed"
+
+
+def test_interrupted_export_resumes(
+    sample_col: SampleCollection, tmp_path: Path
+) -> None:
+    dest = tmp_path / "out"
+    export_iter = DeckMediaExporter(sample_col.col, sample_col.top).export(
+        dest, workers=1
+    )
+    # Stopped after the files of the first note were queued
+    next(export_iter)
+    export_iter.close()
+    written = ExportManifest(dest).names()
+    assert set(written) <= {"a.jpg", "c.mp3"}
+    counters = run_export(DeckMediaExporter(sample_col.col, sample_col.top), dest)
+    assert counters["unchanged"] == len(written)
+    assert counters["exported"] == 4
+    assert exported_files(dest) == {"a.jpg", "b.png", "c.mp3", "dup.jpg"}
+
+
+def test_filtered_copies_share_scan(
+    sample_col: SampleCollection, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top)
+    assert exporter.all_extensions() == {"jpg", "png", "mp3"}
+
+    def rescan(*args: object) -> None:
+        raise AssertionError("notes scanned again")
+
+    monkeypatch.setattr(exporter_module, "get_fields_media", rescan)
+    filtered = exporter.with_filters(["Front"], {"jpg", "png"})
+    assert filtered.scan is exporter.scan
+    assert filtered.all_extensions() == {"jpg", "png"}
+    assert [file.filename for file in filtered.plan().files] == [
+        "a.jpg",
+        "b.png",
+        "dup.jpg",
+    ]
+    assert exporter.fields is None and exporter.exts is None
+
+
+def test_subfolders(sample_col: SampleCollection, tmp_path: Path) -> None:
+    exporter = DeckMediaExporter(
+        sample_col.col, sample_col.top, organize_into_subfolders=True
+    )
+    run_export(exporter, tmp_path / "out")
+    assert exported_files(tmp_path / "out") == {
+        "Top/a.jpg",
+        "Top/c.mp3",
+        "Top__Sub/b.png",
+        "Top__Sub/dup.jpg",
+    }
+
+
+SUBFOLDER_FILES = {"Top/a.jpg", "Top/c.mp3", "Top__Sub/b.png", "Top__Sub/dup.jpg"}
+
+
+def test_zip_members(sample_col: SampleCollection, tmp_path: Path) -> None:
+    path = tmp_path / "out.zip"
+    exporter = DeckMediaExporter(
+        sample_col.col, sample_col.top, organize_into_subfolders=True
+    )
+    run_export(exporter, ZipSink(path))
+    with zipfile.ZipFile(path) as archive:
+        assert set(archive.namelist()) == SUBFOLDER_FILES
+        assert archive.read("Top__Sub/b.png") == MEDIA["b.png"]
+        assert archive.getinfo("Top/c.mp3").compress_type == zipfile.ZIP_STORED
+
+
+def test_tar_members(sample_col: SampleCollection, tmp_path: Path) -> None:
+    path = tmp_path / "out.tar.gz"
+    exporter = DeckMediaExporter(
+        sample_col.col, sample_col.top, organize_into_subfolders=True
+    )
+    run_export(exporter, make_archive_sink(path, "tar.gz"))
+    with tarfile.open(path) as archive:
+        assert set(archive.getnames()) == SUBFOLDER_FILES
+        file = archive.extractfile("Top/c.mp3")
+        assert file is not None and file.read() == MEDIA["c.mp3"]
+
+
+def test_dedupe(sample_col: SampleCollection, tmp_path: Path) -> None:
+    dest = tmp_path / "out"
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top)
+    counters = run_export(exporter, FolderSink(dest, dedupe=True))
+    assert counters["linked"] == 1
+    assert os.path.samefile(dest / "a.jpg", dest / "dup.jpg")
+    assert not os.path.samefile(dest / "a.jpg", dest / "b.png")
+
+
+def test_link_mode(
+    sample_col: SampleCollection, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # Clones would be used instead of hard links on filesystems that support them
+    monkeypatch.setattr(fileops, "reflink", lambda src_path, dest_path: False)
+    dest = tmp_path / "out"
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top)
+    run_export(exporter, FolderSink(dest, link_mode=LINK_MODE_LINK))
+    assert os.path.samefile(dest / "b.png", os.path.join(sample_col.media_dir, "b.png"))
+
+
+def test_search_exporter_with_note_ids(sample_col: SampleCollection) -> None:
+    col = sample_col.col
+    nids = col.find_notes("deck:Top::Sub")
+    exporter = SearchMediaExporter(col, list(reversed(nids)))
+    assert exporter.note_ids == list(reversed(nids))
+    assert exporter.note_count == 2
+    assert [note.id for note in exporter.notes] == list(reversed(nids))
+    plan = exporter.plan()
+    assert [file.filename for file in plan.files] == ["dup.jpg", "a.jpg", "b.png"]
+    assert plan.missing == ["missing.png"]
+    search = SearchMediaExporter(col, "deck:Top::Sub")
+    assert sorted(search.note_ids) == sorted(nids)
+
+
+def test_deck_tree(sample_col: SampleCollection, tmp_path: Path) -> None:
+    exporter = MultiDeckMediaExporter.from_tree(sample_col.col, sample_col.top)
+    run_export(exporter, tmp_path / "out")
+    assert exported_files(tmp_path / "out") == {
+        "Top/a.jpg",
+        "Top/c.mp3",
+        "Top__Sub/a.jpg",
+        "Top__Sub/b.png",
+        "Top__Sub/dup.jpg",
+    }
+
+
+def test_tar_hard_links(sample_col: SampleCollection, tmp_path: Path) -> None:
+    path = tmp_path / "out.tar"
+    exporter = MultiDeckMediaExporter.from_tree(sample_col.col, sample_col.top)
+    counters = run_export(exporter, TarSink(path))
+    assert counters["linked"] == 1
+    with tarfile.open(path) as archive:
+        link = archive.getmember("Top__Sub/a.jpg")
+        assert link.islnk() and link.linkname == "Top/a.jpg"
+        archive.extractall(tmp_path / "extracted")
+    assert (tmp_path / "extracted" / "Top__Sub" / "a.jpg").read_bytes() == MEDIA[
+        "a.jpg"
+    ]
+
+
+def add_notetype(sample_col: SampleCollection, name: str, fields: list[str]) -> None:
+    models = sample_col.col.models
+    notetype = models.new(name)
+    for field in fields:
+        models.add_field(notetype, models.new_field(field))
+    template = models.new_template("Card 1")
+    template["qfmt"] = f"{{{{{fields[0]}}}}}"
+    models.add_template(notetype, template)
+    models.add_dict(notetype)
+
+
+def test_all_fields(sample_col: SampleCollection) -> None:
+    col = sample_col.col
+    add_notetype(sample_col, "Extra", ["Front", "Extra"])
+    add_notetype(sample_col, "Unused", ["Unused"])
+    note = col.new_note(col.models.by_name("Extra"))
+    note["Extra"] = '<img src="b.png">'
+    col.add_note(note, sample_col.sub)
+    exporter = DeckMediaExporter(col, sample_col.top)
+    assert exporter.all_fields() == ["Front", "Back", "Extra"]
+    # Taken from the scan once there is one
+    exporter.plan()
+    assert exporter.all_fields() == ["Front", "Back", "Extra"]
+    extra = exporter.with_filters(["Extra"], None)
+    assert [file.filename for file in extra.plan().files] == ["b.png"]
+
+
+def test_plan_counts(sample_col: SampleCollection) -> None:
+    plan = DeckMediaExporter(sample_col.col, sample_col.top).plan()
+    assert plan.note_count == 3
+    assert plan.references == 6
+    assert plan.duplicates == 1
+    assert plan.filtered == 0
+    assert plan.missing == ["missing.png"]
+    assert plan.shared == {"a.jpg": 2}
+    assert [file.filename for file in plan.files] == [
+        "a.jpg",
+        "c.mp3",
+        "b.png",
+        "dup.jpg",
+    ]
+    assert plan.total_bytes == sum(len(data) for data in MEDIA.values())
+
+
+def test_plan_filters(sample_col: SampleCollection) -> None:
+    plan = DeckMediaExporter(sample_col.col, sample_col.top, exts={"jpg"}).plan()
+    assert plan.filtered == 3
+    assert not plan.missing
+    assert {file.filename for file in plan.files} == {"a.jpg", "dup.jpg"}
+    plan = DeckMediaExporter(sample_col.col, sample_col.top, fields=["Front"]).plan()
+    assert plan.references == 4
+    assert {file.filename for file in plan.files} == {"a.jpg", "b.png", "dup.jpg"}
+
+
+def test_plan_deck_tree_links_copies(sample_col: SampleCollection) -> None:
+    plan = MultiDeckMediaExporter.from_tree(sample_col.col, sample_col.top).plan()
+    assert [
+        (file.folder.as_posix(), file.filename, file.first) for file in plan.files
+    ] == [
+        ("Top", "a.jpg", True),
+        ("Top", "c.mp3", True),
+        ("Top__Sub", "a.jpg", False),
+        ("Top__Sub", "b.png", True),
+        ("Top__Sub", "dup.jpg", True),
+    ]
+
+
+@pytest.mark.parametrize(
+    "make_exporter",
+    [
+        lambda sample: DeckMediaExporter(sample.col, sample.top),
+        lambda sample: DeckMediaExporter(sample.col, sample.top, exts={"jpg", "mp3"}),
+        lambda sample: DeckMediaExporter(
+            sample.col, sample.top, organize_into_subfolders=True
+        ),
+        lambda sample: MultiDeckMediaExporter.from_tree(sample.col, sample.top),
+    ],
+)
+def test_pipeline_matches_export(
+    sample_col: SampleCollection,
+    tmp_path: Path,
+    make_exporter: Callable[[SampleCollection], MediaExporter],
+) -> None:
+    expected = run_export(make_exporter(sample_col), tmp_path / "export")
+    stats = asyncio.run(
+        export_async(make_exporter(sample_col), FolderSink(tmp_path / "pipeline"))
+    )
+    assert exported_files(tmp_path / "pipeline") == exported_files(tmp_path / "export")
+    for counter in ("references", "duplicates", "filtered", "missing", "exported"):
+        assert stats.counters[counter] == expected[counter], counter
+
+
+def test_pipeline_continues_partial_scan(
+    sample_col: SampleCollection, tmp_path: Path
+) -> None:
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top)
+    scan_iter = exporter.scan_iter()
+    next(scan_iter)
+    scan_iter.close()
+    stats = asyncio.run(export_async(exporter, FolderSink(tmp_path / "out")))
+    assert stats.counters["notes"] == 3
+    assert exported_files(tmp_path / "out") == {"a.jpg", "b.png", "c.mp3", "dup.jpg"}
+
+
+def test_pipeline_lists_media_once(
+    sample_col: SampleCollection, tmp_path: Path, media_dir_calls: Counter
+) -> None:
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top)
+    asyncio.run(export_async(exporter, FolderSink(tmp_path / "out")))
+    assert media_dir_calls == {"listings": 1, "stats": 4}
+
+
+def test_filtered_export_stats_included_files(
+    sample_col: SampleCollection, tmp_path: Path, media_dir_calls: Counter
+) -> None:
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top, exts={"mp3"})
+    assert run_export(exporter, tmp_path / "out")["exported"] == 1
+    assert media_dir_calls["stats"] == 1
+
+
+def test_extension_sizes(sample_col: SampleCollection) -> None:
+    scan = DeckMediaExporter(sample_col.col, sample_col.top).scan
+    assert not scan.extension_bytes
+    scan.update_extension_sizes()
+    assert scan.extension_bytes == {
+        "jpg": len(MEDIA["a.jpg"]) + len(MEDIA["dup.jpg"]),
+        "png": len(MEDIA["b.png"]),
+        "mp3": len(MEDIA["c.mp3"]),
+    }
+    assert scan.extension_missing == {"png": 1}
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+import pytest
+
+from src import media_index as media_index_module
+from src.exporter import DeckMediaExporter
+from src.media_index import MediaReferenceIndex
+
+from .conftest import SampleCollection
+
+
+def scan(sample_col: SampleCollection, index: MediaReferenceIndex) -> DeckMediaExporter:
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top, index=index)
+    exporter.scan  # pylint: disable=pointless-statement
+    return exporter
+
+
+def backdate_notes(sample_col: SampleCollection) -> None:
+    """Move the modification times of the notes out of the current second, so they can be indexed."""
+    sample_col.col.db.execute("update notes set mod = mod - 10")
+
+
+def test_index_reuses_entries(sample_col: SampleCollection, tmp_path: Path) -> None:
+    backdate_notes(sample_col)
+    index = MediaReferenceIndex(tmp_path / "index.db")
+    assert scan(sample_col, index).scan_stats.counters["notes_cached"] == 0
+    exporter = scan(sample_col, index)
+    assert exporter.scan_stats.counters["notes_cached"] == 3
+    assert set(exporter.scan.names) == {
+        "a.jpg",
+        "b.png",
+        "c.mp3",
+        "dup.jpg",
+        "missing.png",
+    }
+
+
+def test_index_skips_notes_modified_this_second(
+    sample_col: SampleCollection, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    col = sample_col.col
+    backdate_notes(sample_col)
+    nid = col.find_notes('"Back:[sound:c.mp3]"')[0]
+    mod = col.db.scalar("select mod from notes where id = ?", nid)
+    monkeypatch.setattr(media_index_module.time, "time", lambda: mod + 0.5)
+    index = MediaReferenceIndex(tmp_path / "index.db")
+    scan(sample_col, index)
+    # Edited again within the same second
+    col.db.execute(
+        "update notes set flds = ? where id = ?",
+        '<img src="a.jpg">\x1f[sound:x.ogg]',
+        nid,
+    )
+    exporter = scan(sample_col, index)
+    assert "x.ogg" in exporter.scan.names and "c.mp3" not in exporter.scan.names
+
+
+def test_index_invalidated_by_latex_settings(
+    sample_col: SampleCollection, tmp_path: Path
+) -> None:
+    col = sample_col.col
+    nid = col.find_notes('"Back:[sound:c.mp3]"')[0]
+    col.db.execute(
+        "update notes set flds = ? where id = ?", "[latex]x[/latex]\x1f", nid
+    )
+    backdate_notes(sample_col)
+    index = MediaReferenceIndex(tmp_path / "index.db")
+    assert any(name.endswith(".png") for name in scan(sample_col, index).scan.names)
+    notetype = col.models.by_name("Basic")
+    notetype["latexsvg"] = True
+    col.models.update_dict(notetype)
+    exporter = scan(sample_col, index)
+    assert exporter.scan_stats.counters["notes_cached"] == 0
+    latex = [name for name in exporter.scan.names if name.startswith("latex-")]
+    assert len(latex) == 1 and latex[0].endswith(".svg")
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import unicodedata
+from pathlib import Path
+
+from src.mirror import MediaMirror
+
+from .conftest import SampleCollection, exported_files
+
+
+def test_mirror(sample_col: SampleCollection, tmp_path: Path) -> None:
+    col = sample_col.col
+    dest = tmp_path / "mirror"
+    mirror = MediaMirror(col, sample_col.top, dest)
+    changes = mirror.sync()
+    assert changes.write == ["a.jpg", "b.png", "c.mp3", "dup.jpg", "missing.png"]
+    stats = mirror.apply(changes)
+    assert stats.counters["exported"] == 4
+    assert stats.counters["missing"] == 1
+    assert exported_files(dest) == {"a.jpg", "b.png", "c.mp3", "dup.jpg"}
+    assert not mirror.refresh()
+
+    # Added, with a name stored decomposed on disk
+    name = "café.jpg"
+    (Path(sample_col.media_dir) / unicodedata.normalize("NFD", name)).write_bytes(
+        b"new"
+    )
+    note = col.new_note(col.models.by_name("Basic"))
+    note["Front"] = f'<img src="{name}">'
+    col.add_note(note, sample_col.sub)
+    changes = mirror.refresh()
+    assert changes.write == [name] and not changes.remove
+    mirror.apply(changes)
+    assert (dest / name).read_bytes() == b"new"
+
+    # Edited without being saved yet, e.g. in the editor
+    nid = col.find_notes('"Back:[sound:c.mp3]"')[0]
+    edited = col.get_note(nid)
+    edited["Back"] = ""
+    changes = mirror.refresh([edited])
+    assert changes.remove == ["c.mp3"] and not changes.write
+    mirror.apply(changes)
+    assert not (dest / "c.mp3").exists()
+    col.update_note(edited)
+
+    # Removed
+    col.remove_notes([note.id])
+    changes = mirror.refresh()
+    assert changes.remove == [name]
+    stats = mirror.apply(changes)
+    assert stats.counters["removed"] == 1
+    assert exported_files(dest) == {"a.jpg", "b.png", "dup.jpg"}
+
+
+def test_mirror_sync_removes_stale_files(
+    sample_col: SampleCollection, tmp_path: Path
+) -> None:
+    dest = tmp_path / "mirror"
+    mirror = MediaMirror(sample_col.col, sample_col.top, dest)
+    mirror.apply(mirror.sync())
+    sample_col.col.remove_notes(sample_col.col.find_notes("deck:Top::Sub"))
+    mirror = MediaMirror(sample_col.col, sample_col.top, dest)
+    changes = mirror.sync()
+    assert changes.remove == ["b.png", "dup.jpg"]
+    mirror.apply(changes)
+    assert exported_files(dest) == {"a.jpg", "c.mp3"}
+
+
+def test_mirror_refresh_finds_notes_with_older_mod(
+    sample_col: SampleCollection, tmp_path: Path
+) -> None:
+    col = sample_col.col
+    mirror = MediaMirror(col, sample_col.top, tmp_path / "mirror")
+    mirror.apply(mirror.sync())
+    # As if changed on another device before the last refresh, then synced
+    nid = col.find_notes('"Back:[sound:c.mp3]"')[0]
+    mod = col.db.scalar("select min(mod) from notes") - 1
+    col.db.execute(
+        "update notes set flds = ?, mod = ? where id = ?",
+        '<img src="a.jpg">\x1f',
+        mod,
+        nid,
+    )
+    changes = mirror.refresh()
+    assert changes.remove == ["c.mp3"] and not changes.write
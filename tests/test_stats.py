@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+from pathlib import Path
+
+from src.exporter import DeckMediaExporter
+from src.stats import ExportProgress, format_duration
+
+from .conftest import MEDIA, SampleCollection
+
+
+def test_progress_by_bytes() -> None:
+    progress = ExportProgress(1, 4, 2, 4, 512, 2048, 2.0)
+    assert progress.fraction == 0.25
+    assert progress.throughput == 256
+    assert progress.eta == 6
+    assert progress.describe() == (
+        "Exported 2 of 4 files (512 B of 2.0 KB, 256 B/s, about 6s left)"
+    )
+
+
+def test_progress_by_files_without_bytes() -> None:
+    progress = ExportProgress(1, 4, 1, 4, 0, 0, 1.0)
+    assert progress.fraction == 0.25
+    assert progress.eta is None
+
+
+def test_progress_while_scanning() -> None:
+    progress = ExportProgress(3, 4, 1, 0, 100, 0, 1.0, totals_known=False)
+    assert progress.fraction == 0.75
+    assert progress.eta is None
+    assert progress.describe().startswith("Scanned 3 of 4 notes, exported 1 files")
+
+
+def test_finished_progress() -> None:
+    progress = ExportProgress(4, 4, 3, 4, 10, 20, 1.0, finished=True)
+    assert progress.fraction == 1.0
+    assert progress.eta == 0.0
+
+
+def test_format_duration() -> None:
+    assert format_duration(59.4) == "59s"
+    assert format_duration(61) == "1m 1s"
+    assert format_duration(3725) == "1h 2m"
+
+
+def test_export_progress(sample_col: SampleCollection, tmp_path: Path) -> None:
+    updates: list[ExportProgress] = []
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top)
+    for _ in exporter.export(tmp_path / "out", progress=updates.append):
+        pass
+    final = updates[-1]
+    assert final.finished
+    assert final.note_count == 3 and final.notes_done == 3
+    assert final.files_done == final.file_count == 4
+    assert final.bytes_done == final.total_bytes == sum(map(len, MEDIA.values()))
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Callable
+
+import pytest
+
+from src import transcode as transcode_module
+from src.exporter import DeckMediaExporter, ExportWriter
+from src.media_dir import MediaDirIndex
+from src.sinks import FolderSink
+from src.stats import ExportStats
+from src.transcode import TranscodeOptions, Transcoder
+
+from .conftest import MEDIA, SampleCollection, exported_files
+
+# Pillow is optional
+Image = pytest.importorskip("PIL.Image")
+
+
+@pytest.fixture
+def in_threads(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Convert files in threads, like bundled Anki builds, instead of starting processes."""
+    monkeypatch.setattr(sys, "frozen", True, raising=False)
+
+
+def make_image(path: Path, size: int = 200) -> None:
+    # Noise doesn't compress well, so smaller versions are smaller files
+    Image.effect_noise((size, size), 64).convert("RGB").save(path)
+
+
+def image_transcoder(cache_dir: Path) -> Transcoder:
+    return Transcoder(TranscodeOptions(images=True, image_max_size=50), cache_dir)
+
+
+@pytest.mark.usefixtures("in_threads")
+def test_converted_images_are_cached(tmp_path: Path) -> None:
+    src = tmp_path / "big.png"
+    make_image(src)
+    transcoder = image_transcoder(tmp_path / "cache")
+    path, name, status = transcoder.transcode(str(src), "big.png")
+    assert (name, status) == ("big.png", "converted")
+    with Image.open(path) as image:
+        assert image.size == (50, 50)
+    assert transcoder.transcode(str(src), "big.png") == (path, name, "cached")
+    transcoder.close()
+
+
+@pytest.mark.usefixtures("in_threads")
+def test_failed_conversions_export_files_unchanged(
+    sample_col: SampleCollection, tmp_path: Path
+) -> None:
+    # The images of the sample collection aren't valid images
+    exporter = DeckMediaExporter(sample_col.col, sample_col.top)
+    transcoder = image_transcoder(tmp_path / "cache")
+    dest = tmp_path / "out"
+    for _ in exporter.export(dest, transcoder=transcoder):
+        pass
+    transcoder.close()
+    assert exporter.stats is not None
+    assert exporter.stats.counters["transcode_failed"] == 3
+    assert exported_files(dest) == set(MEDIA)
+    for filename, data in MEDIA.items():
+        assert (dest / filename).read_bytes() == data
+
+
+class BrokenPool(ThreadPoolExecutor):
+    """Process pool whose workers can't be started."""
+
+    def submit(self, fn: Callable, /, *args: Any, **kwargs: Any) -> Future:
+        future: Future = Future()
+        future.set_exception(BrokenProcessPool("workers can't be started"))
+        return future
+
+
+def test_falls_back_to_threads(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(transcode_module, "ProcessPoolExecutor", BrokenPool)
+    src = tmp_path / "big.png"
+    make_image(src)
+    transcoder = image_transcoder(tmp_path / "cache")
+    assert transcoder.transcode(str(src), "big.png")[2] == "converted"
+    executor = transcoder.executor
+    assert isinstance(executor, ThreadPoolExecutor)
+    assert not isinstance(executor, BrokenPool)
+    transcoder.close()
+
+
+@pytest.mark.usefixtures("in_threads")
+def test_decompression_bombs_export_unchanged(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    src = tmp_path / "big.png"
+    make_image(src)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+    stats = ExportStats()
+    transcoder = image_transcoder(tmp_path / "cache")
+    writer = ExportWriter(FolderSink(tmp_path / "out"), stats, transcoder)
+    assert writer.write(str(src), Path(), "big.png") is not None
+    transcoder.close()
+    assert stats.counters["transcode_failed"] == 1
+    assert (tmp_path / "out" / "big.png").read_bytes() == src.read_bytes()
+
+
+@pytest.mark.usefixtures("in_threads")
+def test_converted_name_taken(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(transcode_module, "find_ffmpeg", lambda: "missing-ffmpeg")
+    for filename in ("foo.wav", "foo.mp3", "bar.wav"):
+        (tmp_path / filename).write_bytes(b"sound")
+    files = MediaDirIndex(str(tmp_path))
+    transcoder = Transcoder(TranscodeOptions(audio=True), tmp_path / "cache")
+    # Exported unconverted, so that foo.mp3 isn't overwritten
+    src = str(tmp_path / "foo.wav")
+    assert transcoder.transcode(src, "foo.wav", files) == (src, "foo.wav", None)
+    # Converted, which fails without ffmpeg
+    with pytest.raises(OSError):
+        transcoder.transcode(str(tmp_path / "bar.wav"), "bar.wav", files)
+    transcoder.close()